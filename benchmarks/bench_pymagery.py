@@ -0,0 +1,272 @@
+"""
+timings and peak memory of pymagery's io and processing hot paths, on
+synthetic dems and imagery of a few sizes
+
+    python -m benchmarks.bench_pymagery --sizes 1000 4000 --save base.json
+    python -m benchmarks.bench_pymagery --sizes 1000 4000 --compare base.json
+
+peak memory is what numpy allocates (via tracemalloc), gdal's own buffers
+aren't counted. cold reads start w/ pymagery's and gdal's caches emptied,
+but the os's file cache can still be warm
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+from osgeo import gdal
+
+import pymagery
+from pymagery import terrain
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """
+    register <func>(data) -> a zero-arg callable to time. setup done in
+    <func> isn't timed
+    """
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def cold(func):
+    """
+    mark <func> (a zero-arg callable to time) to run w/ empty caches
+    """
+    func.setup = drop_caches
+    return func
+
+
+def drop_caches():
+    """
+    empty pymagery's dataset/pixel cache and gdal's block cache
+    """
+    pymagery.cache.clear()
+    # shrinking gdal's cache flushes the blocks that don't fit
+    cache_max = gdal.GetCacheMax()
+    gdal.SetCacheMax(0)
+    gdal.SetCacheMax(cache_max)
+
+
+def synthetic_dem(n, seed=0):
+    """
+    n x n float32 hills w/ some nan voids and negative spikes
+    """
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 8 * np.pi, n, dtype=np.float32)
+    dem = (np.sin(x)[:, None] * np.cos(x / 3)[None, :] * 200 + 500
+           + rng.normal(0, 2, (n, n)).astype(np.float32))
+    n_voids = max(n // 100, 1)
+    for i, j in rng.integers(0, n, (n_voids, 2)):
+        dem[i:i + n // 50 + 1, j:j + n // 50 + 1] = np.nan
+    dem[tuple(rng.integers(0, n, (2, n_voids)))] = -9999
+    return dem
+
+
+def synthetic_imagery(n, n_bands=4, seed=0):
+    """
+    (n_bands, n, n) uint16, like sentinel reflectances
+    """
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 10000, (n_bands, n, n), dtype=np.uint16)
+
+
+class Data:
+    '''
+    synthetic rasters of one size, in memory and on disk
+    '''
+
+    def __init__(self, n, tmp_dir):
+        self.n = n
+        aff = pymagery.affine.Affine(10, 0, 500000, 0, -10, 5000000)
+        self.dem = pymagery.SingleBand(
+            band=pymagery.Band(synthetic_dem(n), dtype=None),
+            aff=aff, crs='epsg:32610')
+        self.imagery = pymagery.MultiBand.from_array(
+            synthetic_imagery(n), names=['b', 'g', 'r', 'nir'], aff=aff,
+            crs='epsg:32610')
+        self.dem_path = os.path.join(tmp_dir, f'dem_{n}.tif')
+        self.imagery_path = os.path.join(tmp_dir, f'imagery_{n}.tif')
+        self.dem.to_path(self.dem_path)
+        self.imagery.to_path(self.imagery_path)
+
+
+@benchmark
+def from_path_dem(data):
+    return cold(lambda: pymagery.Raster.from_path(data.dem_path))
+
+
+@benchmark
+def from_path_dem_warm(data):
+    return lambda: pymagery.Raster.from_path(data.dem_path)
+
+
+@benchmark
+def from_path_imagery(data):
+    return cold(lambda: pymagery.Raster.from_path(data.imagery_path,
+                                                  dtype=None))
+
+
+@benchmark
+def from_path_imagery_warm(data):
+    return lambda: pymagery.Raster.from_path(data.imagery_path, dtype=None)
+
+
+@benchmark
+def band_from_uint16(data):
+    arr = np.asarray(data.imagery.iloc[0])
+    return lambda: pymagery.Band(arr)
+
+
+@benchmark
+def fill_nans(data):
+    return lambda: data.dem.fill_nans(0)
+
+
+@benchmark
+def fill_negs(data):
+    return lambda: data.dem.fill_negs(0)
+
+
+@benchmark
+def interp(data):
+    return lambda: data.dem.interp()
+
+
+@benchmark
+def arr_stack(data):
+    # not buffer-backed, so arr has to stack the bands
+    imagery = pymagery.MultiBand(
+        bands=pymagery.Bands(dict(data.imagery.bands.items())))
+    return lambda: imagery.arr
+
+
+@benchmark
+def mk_hill_shade(data):
+    def run():
+        # hillshades are cached, time computing one
+        terrain.clear_cache()
+        data.dem.mk_hill_shade()
+    return run
+
+
+@benchmark
+def geo_pix_round_trip(data):
+    rng = np.random.default_rng(0)
+    i, j = rng.integers(0, data.n, (2, 10 ** 6))
+
+    def run():
+        x, y = data.dem.pix_to_geo(i, j)
+        data.dem.geo_to_pix(x, y)
+    return run
+
+
+def measure(func, repeat=3):
+    """
+    :param func: zero-arg callable. its .setup, if it has one, is run
+        (untimed) before each run
+    :return: dict of seconds (best of <repeat> runs) and peak_bytes
+    """
+    setup = getattr(func, 'setup', lambda: None)
+    seconds = []
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    setup()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(seconds), 'peak_bytes': peak}
+
+
+def run(sizes, names=None, repeat=3):
+    """
+    :return: dict of '<benchmark>[<size>]': measurements
+    """
+    names = names or list(BENCHMARKS)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n in sizes:
+            data = Data(n, tmp_dir)
+            for name in names:
+                key = f'{name}[{n}]'
+                results[key] = measure(BENCHMARKS[name](data), repeat)
+                print(f'{key:32} {results[key]["seconds"]:10.4f} s '
+                      f'{results[key]["peak_bytes"] / 2 ** 20:10.1f} MiB',
+                      flush=True)
+            del data
+    return results
+
+
+def environment():
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'gdal': gdal.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count()}
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    print each benchmark's time and memory relative to <baseline>
+    :param tolerance: fraction slower/bigger to report as a regression
+    :return: list of regressed benchmarks
+    """
+    regressions = []
+    print(f'\n{"benchmark":32} {"time":>8} {"memory":>8}')
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        time_ratio = result['seconds'] / max(base['seconds'], 1e-9)
+        mem_ratio = (result['peak_bytes'] + 1) / (base['peak_bytes'] + 1)
+        flag = ''
+        if time_ratio > 1 + tolerance or mem_ratio > 1 + tolerance:
+            flag = '  <- regression'
+            regressions.append(key)
+        print(f'{key:32} {time_ratio:7.2f}x {mem_ratio:7.2f}x{flag}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 2000],
+                        help='edge lengths (pixels) of the synthetic rasters')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS),
+                        help='benchmarks to run, defaults to all')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='write results to this json file')
+    parser.add_argument('--compare', help='baseline json file to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.only, args.repeat)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f,
+                      indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['environment'] != environment():
+            print('warning: baseline is from a different environment: '
+                  f'{baseline["environment"]}')
+        if compare(results, baseline['results'], args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,67 +1,471 @@
+import os
+import re
+import ast
+import asyncio
+import weakref
 import warnings
+import threading
+from concurrent.futures import (Executor, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from multiprocessing import shared_memory
+from functools import lru_cache, partial
 import numpy as np
-from osgeo import gdal
+from osgeo import gdal, gdal_array, osr
 import rasterio
 import rasterio.fill
+import rasterio.warp
+import scipy.spatial
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
 import affine
 import shapely
 import shapely.geometry
-import matplotlib as mpl
-import matplotlib.colors
 import matplotlib.pyplot as plt
-from collections import UserDict
+from collections import OrderedDict, UserDict, deque
+from pymagery import cache, terrain
 gdal.UseExceptions()
 
+# default block edge length (pixels) for block-wise processing
+DFLT_BLOCK_SIZE = 512
+
 
 class Band(np.ndarray):
     '''
-    a subclass of np.ndarray that will always have type float (this
+    a subclass of np.ndarray that has type float by default (this
     handles nodatas better), and has new methods to operate as part of
     a Raster class.
     '''
 
-    def __new__(cls, input_array):
-        if type(input_array) is Band:
+    # value marking nodata pixels, for bands that can't use np.nan
+    nodata = None
+    # number of Bands sharing this band copy-on-write, see Bands.copy
+    _cow = 0
+
+    def __new__(cls, input_array, dtype=float, copy=True, nodata=None):
+        """
+        :param dtype: defaults to float so nodatas can be np.nan. use None
+            to keep the input's dtype (e.g. uint16 imagery)
+        :param copy: (bool) if False, wrap <input_array> (e.g. a np.memmap
+            or a view into a bigger buffer) w/o copying it, as long as no
+            dtype conversion is needed
+        :param nodata: value marking nodata pixels, for non-float bands
+        """
+        if type(input_array) is Band and nodata is None and (
+                dtype is None or input_array.dtype == dtype):
             return input_array
         # Input array is an already formed ndarray instance
         # We first cast to be our class type
-        band = np.asarray(input_array).astype(float).view(cls)
+        if copy:
+            arr = np.array(input_array, dtype=dtype)
+        else:
+            arr = np.asarray(input_array, dtype=dtype)
+        band = arr.view(cls)
+        if nodata is not None:
+            band.nodata = nodata
         # Finally, we must return the newly created object:
         return band
 
+    def from_memmap(path, shape, dtype, mode='r', offset=0, nodata=None):
+        """
+        a band backed by a raw binary file, w/o reading it into memory
+        :param mode: np.memmap mode. 'r' is read-only, 'r+' writes through
+            to the file, 'c' is copy-on-write
+        """
+        mm = np.memmap(path, dtype=dtype, mode=mode, shape=shape,
+                       offset=offset)
+        return Band(mm, dtype=None, copy=False, nodata=nodata)
+
     def __array_finalize__(self, band):
         '''
         Necessary to subclass an ndarray. See numpy docs
         '''
         if band is None:
             return
+        self.nodata = getattr(band, 'nodata', None)
+
+    def __reduce__(self):
+        # ndarray's pickle state doesn't include nodata
+        reconstruct, args, state = super().__reduce__()
+        return reconstruct, args, (state, self.nodata)
 
-    def fill_nans(self, val):
+    def __setstate__(self, state):
+        state, self.nodata = state
+        super().__setstate__(state)
+
+    @property
+    def mask(self):
         '''
-        fill nans w/ value <val>
+        boolean array, True where there's no data (np.nan or self.nodata)
         '''
-        filled = self.copy()
-        filled[np.isnan(filled)] = val
+        if np.issubdtype(self.dtype, np.floating):
+            mask = np.isnan(np.asarray(self))
+        else:
+            mask = np.zeros(self.shape, dtype=bool)
+        if self.nodata is not None and not np.isnan(self.nodata):
+            mask |= np.asarray(self) == self.nodata
+        return mask
+
+    def _out(self, inplace=False, out=None):
+        '''
+        where an op should write its result: this band (inplace), <out>
+        (a preallocated array, filled w/ a copy of this band) or a copy
+        '''
+        if inplace:
+            return self
+        if out is None:
+            return self.copy()
+        out[...] = self
+        if isinstance(out, Band):
+            out.nodata = self.nodata
+        return out
+
+    def fill_nans(self, val, inplace=False, out=None):
+        '''
+        fill nodatas (np.nan or self.nodata) w/ value <val>
+        :param inplace: (bool) modify this band instead of a copy
+        :param out: (array) write the result here instead of a new array
+        '''
+        mask = self.mask
+        filled = self._out(inplace, out)
+        filled[mask] = val
         return filled
 
-    def fill_negs(self, val):
+    def fill_negs(self, val, inplace=False, out=None):
         '''
-        fill nans w/ value <val>
+        fill negative values w/ value <val>. nodatas are left alone
+        :param inplace: (bool) modify this band instead of a copy
+        :param out: (array) write the result here instead of a new array
         '''
-        filled = self.copy()
-        filled[filled < 0] = val
+        negs = (self < 0) & ~self.mask
+        filled = self._out(inplace, out)
+        filled[negs] = val
         return filled
 
-    def interp(self):
+    def interp(self, method='fillnodata', max_search_distance=100,
+               inplace=False, out=None, n_neighbors=8, power=2,
+               block_shape=None, max_workers=None):
         '''
-        replace np.nan values w/ spline interpolation
+        replace nodata values by interpolating from valid pixels
+        :param method:
+            'fillnodata': gdal's inverse distance fill, smoothed
+                (rasterio.fill.fillnodata)
+            'tiled': 'fillnodata' run on blocks in parallel threads
+            'nearest': value of the nearest valid pixel bordering the void
+            'idw': inverse distance weighted mean of the <n_neighbors>
+                nearest valid pixels bordering the void
+            'nearest' and 'idw' use a kd-tree of the void edges, so their
+            cost grows w/ the number of nodata pixels, not the raster size
+        :param max_search_distance: (pixels) voids farther than this from
+            valid data are left as nodata
+        :param inplace: (bool) modify this band instead of a copy
+        :param out: (array) write the result here instead of a new array
+        :param n_neighbors, power: 'idw' neighbors and distance exponent
+        :param block_shape, max_workers: block size and threads for 'tiled'
         '''
-        mask = self.fill_nans(0)
-        filled = self.copy()
-        filled = rasterio.fill.fillnodata(filled, mask=mask)
+        mask = self.mask
+        filled = self._out(inplace, out)
+        if not mask.any():
+            return filled
+        if method == 'fillnodata':
+            filled[...] = rasterio.fill.fillnodata(
+                np.asarray(filled), mask=(~mask).astype(np.uint8),
+                max_search_distance=max_search_distance)
+        elif method == 'tiled':
+            _fill_tiled(filled, mask, max_search_distance, block_shape,
+                        max_workers)
+        elif method in ('nearest', 'idw'):
+            k = 1 if method == 'nearest' else n_neighbors
+            _fill_kdtree(filled, mask, max_search_distance, k, power)
+        else:
+            raise ValueError(f'unknown interp method {method!r}')
         return filled
 
 
+class Window:
+    '''
+    a pixel window into a raster. unpacks like a tuple:
+    row_off, col_off, n_rows, n_cols = window
+    '''
+
+    def __init__(self, row_off, col_off, n_rows, n_cols, outer=None):
+        """
+        :param outer: (Window) the padded window that was actually read,
+            set by Raster.iter_blocks when a halo is requested
+        """
+        self.row_off = int(row_off)
+        self.col_off = int(col_off)
+        self.n_rows = int(n_rows)
+        self.n_cols = int(n_cols)
+        self.outer = outer
+
+    def __iter__(self):
+        return iter((self.row_off, self.col_off, self.n_rows, self.n_cols))
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other)
+
+    def __repr__(self):
+        return 'Window({}, {}, {}, {})'.format(*self)
+
+    @property
+    def shape(self):
+        return self.n_rows, self.n_cols
+
+    @property
+    def slices(self):
+        return (slice(self.row_off, self.row_off + self.n_rows),
+                slice(self.col_off, self.col_off + self.n_cols))
+
+    def pad(self, halo, shape):
+        """
+        grow the window by <halo> pixels on each side, clipped to <shape>
+        """
+        n, m = shape
+        row_min = max(self.row_off - halo, 0)
+        col_min = max(self.col_off - halo, 0)
+        row_max = min(self.row_off + self.n_rows + halo, n)
+        col_max = min(self.col_off + self.n_cols + halo, m)
+        return Window(row_min, col_min, row_max - row_min, col_max - col_min)
+
+    def relative_to(self, other):
+        """
+        this window in the pixel coords of window <other>
+        """
+        return Window(self.row_off - other.row_off,
+                      self.col_off - other.col_off, self.n_rows, self.n_cols)
+
+    def trim(self, block):
+        """
+        drop the halo from a raster that was read (or computed) over
+        self.outer
+        """
+        if block.shape == self.shape or self.outer is None:
+            return block
+        return block.read_window(self.relative_to(self.outer))
+
+
+def _block_windows(shape, block_shape, halo=0):
+    """
+    windows tiling an array of <shape>, each w/ .outer padded by <halo>
+    """
+    n, m = shape
+    n_rows, n_cols = block_shape
+    for row_off in range(0, n, n_rows):
+        for col_off in range(0, m, n_cols):
+            window = Window(row_off, col_off, min(n_rows, n - row_off),
+                            min(n_cols, m - col_off))
+            window.outer = window.pad(halo, shape)
+            yield window
+
+
+def _fill_kdtree(arr, mask, max_search_distance, k=1, power=2):
+    """
+    fill <arr> where <mask> from the k nearest valid pixels that border
+    the voids, inverse distance weighted. in place
+    """
+    void_rows, void_cols = np.nonzero(mask)
+    # valid 8-neighbors of void pixels
+    offsets = [(di, dj) for di in (-1, 0, 1) for dj in (-1, 0, 1)
+               if di or dj]
+    edge_rows = np.concatenate([void_rows + di for di, dj in offsets])
+    edge_cols = np.concatenate([void_cols + dj for di, dj in offsets])
+    inside = ((edge_rows >= 0) & (edge_rows < arr.shape[0])
+              & (edge_cols >= 0) & (edge_cols < arr.shape[1]))
+    edge_rows, edge_cols = edge_rows[inside], edge_cols[inside]
+    valid = ~mask[edge_rows, edge_cols]
+    edges = np.unique(np.stack([edge_rows[valid], edge_cols[valid]], axis=1),
+                      axis=0)
+    if len(edges) == 0:
+        return arr
+    edge_vals = np.asarray(arr)[edges[:, 0], edges[:, 1]].astype(float)
+    tree = scipy.spatial.cKDTree(edges)
+    k = min(k, len(edges))
+    dists, idx = tree.query(np.stack([void_rows, void_cols], axis=1), k=k,
+                            distance_upper_bound=max_search_distance)
+    dists, idx = dists.reshape(len(void_rows), k), idx.reshape(-1, k)
+    found = np.isfinite(dists)
+    weights = np.where(found, 1 / np.where(found, dists, 1) ** power, 0)
+    vals = edge_vals[np.where(found, idx, 0)]
+    total = weights.sum(axis=1)
+    filled = total > 0
+    vals = (weights * vals).sum(axis=1)[filled] / total[filled]
+    if not np.issubdtype(arr.dtype, np.floating):
+        vals = np.round(vals)
+    arr[void_rows[filled], void_cols[filled]] = vals
+    return arr
+
+
+def _fill_tiled(arr, mask, max_search_distance, block_shape=None,
+                max_workers=None):
+    """
+    rasterio.fill.fillnodata on blocks of <arr>, in threads. each block
+    gets a halo of <max_search_distance> so it sees the same data as an
+    untiled fill would (smoothing aside). in place
+    """
+    if block_shape is None:
+        block_shape = (DFLT_BLOCK_SIZE, DFLT_BLOCK_SIZE)
+    halo = int(np.ceil(max_search_distance))
+    windows = list(_block_windows(arr.shape, block_shape, halo))
+
+    def fill(window):
+        outer = window.outer
+        block_mask = mask[outer.slices]
+        if not block_mask.any():
+            return window, None
+        filled = rasterio.fill.fillnodata(
+            np.array(arr[outer.slices]), mask=(~block_mask).astype(np.uint8),
+            max_search_distance=max_search_distance)
+        return window, filled[window.relative_to(outer).slices]
+
+    # every block reads the original values before any are written back
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(fill, windows))
+    for window, filled in results:
+        if filled is not None:
+            arr[window.slices] = filled
+    return arr
+
+
+class LazyBand:
+    '''
+    a deferred handle on one band of a gdal dataset. nothing is read from
+    disk until the band is sliced (only the requested window is read) or
+    converted to an array, so shape, bounds etc. are free.
+    '''
+
+    ndim = 2
+
+    def __init__(self, path, band_idx=1, dtype=float):
+        """
+        :param path: (str) anything gdal.Open understands
+        :param band_idx: (int) 1-based gdal band index
+        :param dtype: dtype of bands read, None for the file's dtype
+        """
+        self.path = path
+        self.band_idx = band_idx
+        self._local = threading.local()
+        gdal_band = self.gdal_band
+        if dtype is None:
+            dtype = gdal_array.GDALTypeCodeToNumericTypeCode(
+                gdal_band.DataType)
+        self.dtype = np.dtype(dtype)
+        self.nodata = gdal_band.GetNoDataValue()
+        self.shape = (gdal_band.YSize, gdal_band.XSize)
+        x_block, y_block = gdal_band.GetBlockSize()
+        self.block_shape = (y_block, x_block)
+
+    def __getstate__(self):
+        # gdal handles can't be pickled, they are reopened on demand
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def __repr__(self):
+        return f'LazyBand({self.path!r}, band_idx={self.band_idx})'
+
+    @property
+    def gdal_band(self):
+        # gdal datasets aren't thread safe, so keep one handle per thread
+        ds = getattr(self._local, 'ds', None)
+        if ds is None:
+            ds = cache.open_dataset(self.path)
+            self._local.ds = ds
+        return ds.GetRasterBand(self.band_idx)
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read(self, window=None, out_shape=None):
+        """
+        read pixels from disk
+        :param window: (row_off, col_off, n_rows, n_cols) or None for all
+        :param out_shape: (n_rows, n_cols) to read the window at a reduced
+            resolution. gdal uses the file's overviews for this if it has
+            any, so only a fraction of the pixels are decoded
+        :return: Band
+        """
+        if window is None:
+            window = (0, 0, *self.shape)
+        row_off, col_off, n_rows, n_cols = (int(x) for x in window)
+        if n_rows <= 0 or n_cols <= 0:
+            shape = (max(n_rows, 0), max(n_cols, 0))
+            return Band(np.empty(shape, dtype=self.dtype), dtype=None,
+                        nodata=self.nodata)
+        buf_rows, buf_cols = (None, None) if out_shape is None else out_shape
+        key = (self.band_idx, row_off, col_off, n_rows, n_cols, buf_rows,
+               buf_cols)
+        arr = cache.read(self.path, key, lambda: self.gdal_band.ReadAsArray(
+            col_off, row_off, n_cols, n_rows,
+            buf_xsize=buf_cols, buf_ysize=buf_rows))
+        # arrays from the cache are read-only, bands get their own copy
+        return Band(arr, dtype=self.dtype, copy=not arr.flags.writeable,
+                    nodata=self.nodata)
+
+    @property
+    def overview_count(self):
+        return self.gdal_band.GetOverviewCount()
+
+    def reopen(self):
+        """
+        drop the open gdal handles (all threads) and anything cached for the
+        file, e.g. to see new overviews
+        """
+        self._local = threading.local()
+        cache.forget(self.path)
+
+    def __array__(self, dtype=None, copy=None):
+        arr = np.asarray(self.read())
+        if dtype is not None:
+            arr = arr.astype(dtype)
+        return arr
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 2:
+            raise IndexError(f'too many indices for LazyBand: {key}')
+        key = key + (slice(None),) * (2 - len(key))
+        window, sub_key = [], []
+        for k, n in zip(key, self.shape):
+            if isinstance(k, (int, np.integer)):
+                k = int(k) + n if k < 0 else int(k)
+                if not 0 <= k < n:
+                    raise IndexError(f'index {k} out of bounds for size {n}')
+                window.append((k, 1))
+                sub_key.append(0)
+            elif type(k) is slice and (k.step is None or k.step > 0):
+                start, stop, step = k.indices(n)
+                window.append((start, max(stop - start, 0)))
+                sub_key.append(slice(None, None, step))
+            else:
+                # fancy indexing, read everything and let numpy handle it
+                return self.read()[key]
+        (row_off, n_rows), (col_off, n_cols) = window
+        band = self.read((row_off, col_off, n_rows, n_cols))
+        return band[tuple(sub_key)]
+
+    # band ops read the band and work on it in place, no extra copy
+
+    def fill_nans(self, val, out=None):
+        return self.read().fill_nans(val, inplace=out is None, out=out)
+
+    def fill_negs(self, val, out=None):
+        return self.read().fill_negs(val, inplace=out is None, out=out)
+
+    def interp(self, out=None, **kwargs):
+        return self.read().interp(inplace=out is None, out=out, **kwargs)
+
+
 class I_Locator:
     '''
     this will allow you to access the contents of an instance
@@ -75,32 +479,256 @@ class I_Locator:
         if type(i) in (int, np.int64):
             return list(self.bands.values())[i]
         if type(i) is slice:
-            sl = i
-            print(sl)
-            idx = np.arange(*(x for x in (sl.start, sl.stop, sl.step) if x))
-            return np.array(
-                [self.bands.iloc[i] for i in idx if i < len(self.bands)])
+            buffer = self.bands._buffer_view()
+            if buffer is not None:
+                # views, no copy
+                if self.bands.interleave == 'band':
+                    return buffer[i]
+                return np.moveaxis(buffer[:, :, i], 2, 0)
+            return np.array(list(self.bands.values())[i])
+
+
+def _fits(arr, band):
+    """
+    whether <arr> can be written into <band> w/o broadcasting or a lossy
+    cast
+    """
+    if isinstance(arr, LazyBand):
+        return False
+    arr = np.asarray(arr)
+    return (arr.shape == band.shape
+            and np.can_cast(arr.dtype, band.dtype, casting='safe'))
+
+
+def _release_share(shares, band):
+    """
+    drop a holder (w/ <shares>) of copy-on-write <band>. once only one is
+    left, it gets the band back writeable
+    """
+    del shares[id(band)]
+    band._cow -= 1
+    if band._cow <= 1:
+        band.flags.writeable = band._writeable
+
+
+def _release_shares(shares):
+    """
+    release all the bands a garbage collected Bands shared
+    """
+    for band in list(shares.values()):
+        _release_share(shares, band)
 
 
 class Bands(UserDict):
     '''
     This will behave like a dict, except that its values will automatically
     convert to type Band and it has a method for calling values (bands)
-    by order
+    by order.
+
+    Bands made w/ Bands.from_array are views into one contiguous 3d
+    buffer, so stacking them is free. setting an existing band of such
+    Bands to an array of the same shape that casts safely to the buffer's
+    dtype copies the new values into the buffer. anything else (e.g.
+    floats into a uint16 buffer) replaces the band and drops the buffer,
+    rather than silently casting.
+
+    Bands.copy is copy-on-write: the copies share bands, which are
+    read-only (also when gotten by key) until one of the copies writes to
+    them, through bands.writable(key), setting a band or an inplace op,
+    and so gets its own copy, or until the other copies are garbage
+    collected.
     '''
 
     def __init__(self, *args, **kwargs):
+        self.buffer = None
+        self.interleave = None
+        # id: band, for bands this holds copy-on-write
+        self._shares = {}
+        self._finalizer = None
         # make sure that all the contents are of type Band
         super().__init__(*args, **kwargs)
-        # for i, band in self.items():
-        #     self[i] = Band(band)
+
+    def from_array(arr, keys=None, interleave='band'):
+        """
+        bands that are views into <arr> (no copy)
+        :param arr: 3d array, shape (bands, rows, cols) for
+            interleave='band' or (rows, cols, bands) for interleave='pixel'
+        :param keys: band names, defaults to '0', '1', ...
+        """
+        arr = np.asarray(arr)
+        if arr.ndim != 3:
+            raise ValueError(f'need a 3d array, got shape {arr.shape}')
+        if interleave == 'band':
+            views = list(arr)
+        elif interleave == 'pixel':
+            views = [arr[:, :, i] for i in range(arr.shape[2])]
+        else:
+            raise ValueError(f'interleave must be "band" or "pixel", '
+                             f'not {interleave!r}')
+        if keys is None:
+            keys = [str(i) for i in range(len(views))]
+        keys = list(keys)
+        if len(keys) != len(views):
+            raise ValueError(f'got {len(keys)} keys for {len(views)} bands')
+        bands = Bands({key: Band(view, dtype=None, copy=False)
+                       for key, view in zip(keys, views)})
+        bands.buffer = arr
+        bands.interleave = interleave
+        return bands
+
+    def empty(keys, shape, dtype=float, interleave='band'):
+        """
+        uninitialized, buffer-backed bands
+        :param shape: (rows, cols) of each band
+        """
+        keys = list(keys)
+        if interleave == 'band':
+            arr = np.empty((len(keys), *shape), dtype=dtype)
+        else:
+            arr = np.empty((*shape, len(keys)), dtype=dtype)
+        return Bands.from_array(arr, keys=keys, interleave=interleave)
 
     @property
     def iloc(self):
         return I_Locator(self)
 
+    def copy(self):
+        """
+        O(1) copy-on-write copy, see Bands
+        """
+        bands = Bands()
+        bands.data = dict(self.data)
+        # writes through the buffer are guarded by _buffer_view
+        bands.buffer, bands.interleave = self.buffer, self.interleave
+        for band in self.data.values():
+            if isinstance(band, Band):
+                self._share(band)
+                bands._share(band)
+        return bands
+
+    def _renamed(self, keys):
+        """
+        the same bands (and buffer) under new <keys>, in order
+        """
+        bands = Bands()
+        bands.data = dict(zip(keys, self.data.values()))
+        bands.buffer, bands.interleave = self.buffer, self.interleave
+        for band in self.data.values():
+            if id(band) in self._shares:
+                bands._share(band)
+        return bands
+
+    def _share(self, band):
+        """
+        count this as a holder of <band>, which is read-only while it has
+        more than one. the count drops when this is garbage collected
+        """
+        if id(band) in self._shares:
+            return
+        if not band._cow:
+            band._writeable = band.flags.writeable
+            band.flags.writeable = False
+        band._cow += 1
+        self._shares[id(band)] = band
+        if self._finalizer is None:
+            self._finalizer = weakref.finalize(self, _release_shares,
+                                               self._shares)
+
+    def _unshare(self, band):
+        if id(band) in self._shares:
+            _release_share(self._shares, band)
+
+    def _buffer_view(self):
+        """
+        the buffer, read-only while any of its bands are shared w/ a copy
+        """
+        if self.buffer is None or not any(
+                getattr(band, '_cow', 0) > 1 for band in self.data.values()):
+            return self.buffer
+        view = self.buffer.view()
+        view.flags.writeable = False
+        return view
+
+    def __getstate__(self):
+        # unpickled bands are new arrays, not shared w/ anything
+        state = self.__dict__.copy()
+        state['_shares'] = {}
+        state['_finalizer'] = None
+        return state
+
+    def writable(self, i):
+        """
+        band <i>, copied first if it's shared w/ a copy (see Bands) so it
+        can be written to in place. buffer-backed bands are all copied at
+        once, into a new buffer, so they stay contiguous
+        """
+        band = self.data[i]
+        if getattr(band, '_cow', 0) <= 1:
+            return band
+        if self.buffer is not None:
+            self._own_buffer()
+        else:
+            self._unshare(band)
+            self.data[i] = band.copy()
+        return self.data[i]
+
+    def _own_buffer(self):
+        """
+        swap a buffer shared w/ copies for a copy of it. the copies keep
+        the old one
+        """
+        buffer = np.array(self.buffer, order='K')
+        own = Bands.from_array(buffer, keys=list(self.data),
+                               interleave=self.interleave)
+        for key, band in self.data.items():
+            own.data[key].nodata = band.nodata
+            self._unshare(band)
+        self.data = own.data
+        self.buffer = buffer
+
+    def values(self):
+        return self.data.values()
+
+    def items(self):
+        return self.data.items()
+
     def __setitem__(self, i, band):
-        super().__setitem__(i, Band(band))
+        old = self.data.get(i)
+        if self.buffer is not None:
+            if i in self.data and _fits(band, old):
+                # keep the buffer contiguous by writing into it
+                self.writable(i)[...] = band
+                return
+            # a new band (or one that doesn't fit) can't live in the buffer
+            self.buffer = None
+            self.interleave = None
+        if old is not None:
+            self._unshare(old)
+        if not isinstance(band, (Band, LazyBand)):
+            band = Band(band)
+        super().__setitem__(i, band)
+
+    def __delitem__(self, i):
+        self._unshare(self.data[i])
+        self.buffer = None
+        self.interleave = None
+        super().__delitem__(i)
+
+    def stack(self):
+        """
+        the bands as a (rows, cols, bands) array. free for buffer-backed
+        bands, otherwise a new array
+        """
+        buffer = self._buffer_view()
+        if buffer is None:
+            return np.stack(list(self.values()), axis=2)
+        if self.interleave == 'pixel':
+            return buffer
+        return np.moveaxis(buffer, 0, 2)
+
+    @property
+    def is_lazy(self):
+        return any(isinstance(band, LazyBand) for band in self.values())
 
 
 class Raster:
@@ -112,12 +740,17 @@ class Raster:
         self._crs = None  # to keep track of when crs isn't set
         self._aff = None
         self._bands = None
+        self._previews = OrderedDict()  # decimated reads of lazy bands
         self.crs = crs
         self.aff = aff
         self.bands = bands
 
     def copy(self):
-        return self.__class__(bands=self.bands, crs=self.crs, aff=self.aff)
+        """
+        O(1) copy-on-write copy. the bands are shared, read-only, until
+        they're written to (see Bands.writable), which copies them
+        """
+        return self._from_bands(self.bands.copy())
 
     def __eq__(self, other):
         if self.bands != other.bands:
@@ -128,27 +761,175 @@ class Raster:
             return False
         return True
 
-    def from_path(path):
+    def from_path(path, lazy=False, dtype=float, interleave=None):
         """
         this will return a raster of type SingleBand or MultiBand
+        :param lazy: (bool) if True, bands are LazyBands and no pixels are
+            read until they're needed
+        :param dtype: band dtype, None to keep the file's dtype
+        :param interleave: ('band' or 'pixel') read multi-band files
+            straight into one contiguous buffer (see Bands.from_array)
         """
-        gdal_ds = gdal.Open(path)
+        gdal_ds = cache.open_dataset(path)
         n_bands = gdal_ds.RasterCount
+
+        def read_band(i):
+            band = LazyBand(path, band_idx=i + 1, dtype=dtype)
+            return band if lazy else band.read()
+
+        def read_buffer():
+            buf_dtype = dtype
+            if buf_dtype is None:
+                buf_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(
+                    gdal_ds.GetRasterBand(1).DataType)
+            shape = (gdal_ds.RasterYSize, gdal_ds.RasterXSize)
+            bands = Bands.empty([str(i) for i in range(n_bands)], shape,
+                                dtype=buf_dtype, interleave=interleave)
+            for i, band in enumerate(bands.values()):
+                gdal_band = gdal_ds.GetRasterBand(i + 1)
+                if interleave == 'band':
+                    # contiguous, so gdal can decode straight into it
+                    gdal_band.ReadAsArray(buf_obj=np.asarray(band))
+                else:
+                    band[...] = gdal_band.ReadAsArray()
+                band.nodata = gdal_band.GetNoDataValue()
+            return bands
+
         if n_bands == 1:
-            gdal_band = gdal_ds.GetRasterBand(1)
-            arr = gdal_band.ReadAsArray()
-            raster = SingleBand(band=arr)
+            raster = SingleBand(band=read_band(0))
+        elif interleave is not None and not lazy:
+            raster = MultiBand(bands=read_buffer())
         else:
-            bands = Bands({str(i): gdal_ds.GetRasterBand(i + 1).ReadAsArray()
-                           for i in range(n_bands)})
+            bands = Bands({str(i): read_band(i) for i in range(n_bands)})
             raster = MultiBand(bands=bands)
         c, a, b, f, d, e = gdal_ds.GetGeoTransform()
         raster.aff = affine.Affine(a, b, c, d, e, f)
         raster.crs = gdal_ds.GetProjectionRef()
         return raster
 
-    def from_paths(paths):
-        pass
+    def from_paths(paths, names=None, lazy=False, dtype=float,
+                   max_workers=None):
+        """
+        read single-band files (e.g. sentinel's one jp2 per band)
+        concurrently and stack them into one MultiBand. the files must
+        share a grid.
+        :param names: band names, defaults to the file names w/o extension
+        :param max_workers: (int) reader threads. gdal releases the gil
+            while decoding, so these run in parallel
+        """
+        paths = list(paths)
+        if names is None:
+            names = [os.path.splitext(os.path.basename(path))[0]
+                     for path in paths]
+        if len(names) != len(paths):
+            raise ValueError(f'got {len(names)} names for {len(paths)} paths')
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            rasters = list(executor.map(
+                partial(Raster.from_path, lazy=lazy, dtype=dtype), paths))
+        return _stack_single_bands(rasters, names)
+
+    async def afrom_path(path, lazy=False, dtype=float, interleave=None):
+        """
+        async from_path. gdal reads run on the io executor (see
+        set_io_limits) in strips, so they don't block the event loop and
+        cancelling the task stops the read between strips
+        """
+        raster = await _run_io(Raster.from_path, path, lazy=True, dtype=dtype)
+        if lazy:
+            return raster
+        if interleave is not None:
+            return await _run_io(Raster.from_path, path, dtype=dtype,
+                                 interleave=interleave)
+        return await raster.aread_window((0, 0, *raster.shape))
+
+    async def afrom_paths(paths, names=None, lazy=False, dtype=float):
+        """
+        async from_paths. the files are read concurrently, up to the io
+        limits. if one read fails or this is cancelled, the others are
+        cancelled too
+        """
+        paths = list(paths)
+        if names is None:
+            names = [os.path.splitext(os.path.basename(path))[0]
+                     for path in paths]
+        if len(names) != len(paths):
+            raise ValueError(f'got {len(names)} names for {len(paths)} paths')
+        tasks = [asyncio.ensure_future(
+                     Raster.afrom_path(path, lazy=lazy, dtype=dtype))
+                 for path in paths]
+        try:
+            rasters = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return _stack_single_bands(rasters, names)
+
+    @property
+    def is_lazy(self):
+        return self.bands.is_lazy
+
+    def load(self):
+        """
+        read any lazy bands into memory
+        """
+        if not self.is_lazy:
+            return self
+        bands = Bands({key: band.read() if isinstance(band, LazyBand)
+                       else band for key, band in self.bands.items()})
+        return self._from_bands(bands)
+
+    def _from_bands(self, bands, aff=None, crs=None):
+        """
+        a new raster of the same type (and crs/aff unless given),
+        w/ different bands
+        """
+        raster = self.__class__.__new__(self.__class__)
+        Raster.__init__(raster, bands=bands,
+                        crs=self.crs if crs is None else crs,
+                        aff=self.aff if aff is None else aff)
+        return raster
+
+    def _to_gdal(self):
+        """
+        a gdal dataset of the raster. the file itself if the raster is just
+        the lazy bands of one file, otherwise an in-memory copy
+        """
+        bands = list(self.bands.values())
+        if (all(isinstance(band, LazyBand) for band in bands)
+                and len({band.path for band in bands}) == 1
+                and [band.band_idx for band in bands]
+                == list(range(1, len(bands) + 1))):
+            gdal_ds = gdal.Open(bands[0].path)
+            if gdal_ds.RasterCount == len(bands):
+                return gdal_ds
+        dtype = np.result_type(*(band.dtype for band in bands))
+        gdal_ds = gdal.GetDriverByName('MEM').Create(
+            '', self.M, self.N, self.n_bands,
+            gdal_array.NumericTypeCodeToGDALTypeCode(dtype))
+        gdal_ds.SetGeoTransform(self.aff.to_gdal())
+        if self.crs is not None:
+            gdal_ds.SetProjection(_crs_to_wkt(self.crs))
+        for i, band in enumerate(bands):
+            gdal_band = gdal_ds.GetRasterBand(i + 1)
+            gdal_band.WriteArray(np.asarray(band))
+            if band.nodata is not None:
+                gdal_band.SetNoDataValue(float(band.nodata))
+        return gdal_ds
+
+    def _from_gdal(self, gdal_ds):
+        """
+        a raster of the same type and band names as this one, read from
+        <gdal_ds>
+        """
+        bands = Bands()
+        for i, key in enumerate(self.band_names):
+            gdal_band = gdal_ds.GetRasterBand(i + 1)
+            bands[key] = Band(gdal_band.ReadAsArray(), dtype=None,
+                              copy=False, nodata=gdal_band.GetNoDataValue())
+        return self._from_bands(
+            bands, aff=affine.Affine.from_gdal(*gdal_ds.GetGeoTransform()),
+            crs=gdal_ds.GetProjectionRef())
 
     @property
     def crs(self):
@@ -196,7 +977,7 @@ class Raster:
         """
         this is the bands reshaped for plt.imshow
         """
-        return np.stack(list(self.bands.values()), axis=2)
+        return self.bands.stack()
 
     @arr.setter
     def arr(self, arr):
@@ -242,6 +1023,129 @@ class Raster:
     def M(self):
         return self.shape[1]
 
+    @property
+    def block_shape(self):
+        """
+        a good block shape for iter_blocks: the native gdal block of lazy
+        bands grown to at least DFLT_BLOCK_SIZE on each side (so striped
+        files don't give 1-row blocks), else DFLT_BLOCK_SIZE square
+        """
+        for band in self.bands.values():
+            if isinstance(band, LazyBand):
+                return tuple(
+                    min(b * int(np.ceil(DFLT_BLOCK_SIZE / b)), n)
+                    for b, n in zip(band.block_shape, self.shape))
+        return tuple(min(DFLT_BLOCK_SIZE, n) for n in self.shape)
+
+    def read_window(self, window):
+        """
+        a raster of the same type covering pixel window <window>, w/ a
+        shifted aff. lazy bands only read the window, in-memory bands are
+        views (no copy)
+        """
+        window = Window(*window)
+        bands = Bands({key: band[window.slices]
+                       for key, band in self.bands.items()})
+        aff = None
+        if self.aff is not None:
+            aff = self.aff * affine.Affine.translation(window.col_off,
+                                                       window.row_off)
+        return self._from_bands(bands, aff=aff)
+
+    async def aread_window(self, window, strip_rows=None):
+        """
+        async read_window. lazy bands are read on the io executor one strip
+        of rows at a time, so cancelling stops the read between strips
+        :param strip_rows: (int) rows per read, defaults to the native
+            block height
+        """
+        window = Window(*window)
+        if not self.is_lazy:
+            return self.read_window(window)
+        # clip to the raster, like slicing does in read_window
+        row_min, col_min = max(window.row_off, 0), max(window.col_off, 0)
+        row_max = min(window.row_off + window.n_rows, self.N)
+        col_max = min(window.col_off + window.n_cols, self.M)
+        window = Window(row_min, col_min, max(row_max - row_min, 0),
+                        max(col_max - col_min, 0))
+        if strip_rows is None:
+            strip_rows = self.block_shape[0]
+        bands = Bands({key: Band(np.empty(window.shape, dtype=band.dtype),
+                                 dtype=None, copy=False, nodata=band.nodata)
+                       for key, band in self.bands.items()})
+        for row in range(0, window.n_rows, strip_rows):
+            strip = Window(window.row_off + row, window.col_off,
+                           min(strip_rows, window.n_rows - row),
+                           window.n_cols)
+            block = await _run_io(self.read_window, strip)
+            for band, new_band in zip(bands.values(), block.bands.values()):
+                band[row:row + strip.n_rows] = new_band
+        aff = None
+        if self.aff is not None:
+            aff = self.aff * affine.Affine.translation(window.col_off,
+                                                       window.row_off)
+        return self._from_bands(bands, aff=aff)
+
+    async def acrop(self, geom, crs=None):
+        """
+        async crop, see aread_window
+        """
+        return await self.aread_window(self._crop_window(geom, crs))
+
+    def write_window(self, raster, window):
+        """
+        write <raster> into this (in-memory) raster at <window>. bands are
+        matched by order. any halo read by iter_blocks is dropped.
+        """
+        raster = window.trim(raster)
+        for key, new_band in zip(self.band_names, raster.bands.values()):
+            self.bands.writable(key)[window.slices] = new_band
+
+    def iter_blocks(self, block_shape=None, halo=0):
+        """
+        iterate over the raster block by block, for processing rasters that
+        don't fit in memory (use w/ a lazy raster)
+        :param block_shape: (n_rows, n_cols) defaults to self.block_shape
+        :param halo: (int) pixels of overlap to read around each block, for
+            neighborhood ops
+        :return: generator of (window, block). block is a raster covering
+            window.outer; pass both to write_window to write results back
+        """
+        if block_shape is None:
+            block_shape = self.block_shape
+        for window in _block_windows(self.shape, block_shape, halo):
+            yield window, self.read_window(window.outer)
+
+    def map_blocks(self, func, block_shape=None, halo=0, path=None,
+                   **writer_kwargs):
+        """
+        apply <func> (raster -> raster) block by block
+        :param path: (str) if given, results are streamed to this file and
+            a lazy raster of it is returned. otherwise results are
+            assembled in memory
+        :param writer_kwargs: passed to RasterWriter
+        """
+        out = None
+        for window, block in self.iter_blocks(block_shape, halo=halo):
+            processed = func(block)
+            if out is None:
+                dtype = processed.bands.iloc[0].dtype
+                if path is None:
+                    out = processed._from_bands(
+                        Bands({key: Band(np.empty(self.shape, dtype=dtype),
+                                         dtype=None, copy=False)
+                               for key in processed.band_names}),
+                        aff=self.aff)
+                else:
+                    out = RasterWriter(path, like=self,
+                                       n_bands=processed.n_bands,
+                                       dtype=dtype, **writer_kwargs)
+            out.write_window(processed, window)
+        if path is None:
+            return out
+        out.close()
+        return Raster.from_path(path, lazy=True)
+
     def plot(self, ax=None, figsize=(8, 8)):
         # this just sets up a fig if the user didn't already do so
         if ax is None:
@@ -249,6 +1153,96 @@ class Raster:
             return fig, ax
         return None, ax
 
+    def build_overviews(self, levels=None, resampling='AVERAGE'):
+        """
+        build overviews (.ovr files) for the files behind lazy bands that
+        don't have any yet, to speed up decimated reads
+        :param levels: decimation factors, defaults to halving down to
+            about DFLT_BLOCK_SIZE
+        """
+        lazy_bands = [band for band in self.bands.values()
+                      if isinstance(band, LazyBand)]
+        for path in {band.path for band in lazy_bands}:
+            gdal_ds = gdal.Open(path)
+            if gdal_ds.GetRasterBand(1).GetOverviewCount() > 0:
+                continue
+            if levels is None:
+                levels, factor = [], 2
+                while max(self.shape) / factor >= DFLT_BLOCK_SIZE:
+                    levels.append(factor)
+                    factor *= 2
+            if levels:
+                # a read-only dataset gets an external .ovr file
+                gdal_ds.BuildOverviews(resampling, list(levels))
+            gdal_ds = None
+        for band in lazy_bands:
+            band.reopen()
+
+    def decimate(self, out_shape, window=None, build_overviews=False):
+        """
+        a coarser raster of at least <out_shape> pixels (or the full
+        resolution if that's smaller), w/ a scaled aff. lazy bands are read
+        at the reduced resolution, from overviews if the file has them, and
+        the result is cached.
+        :param out_shape: (n_rows, n_cols)
+        :param window: (Window) only decimate this part of the raster
+        :param build_overviews: (bool) build overviews for lazy bands'
+            files first if they don't have any
+        """
+        if window is None:
+            window = Window(0, 0, *self.shape)
+        window = Window(*window)
+        step = max(1, min(window.n_rows // out_shape[0],
+                          window.n_cols // out_shape[1]))
+        if step == 1:
+            return self.read_window(window)
+        buf_shape = (int(np.ceil(window.n_rows / step)),
+                     int(np.ceil(window.n_cols / step)))
+        # scaled so the decimated raster has the same bounds as <window>
+        aff = self.aff * affine.Affine.translation(
+            window.col_off, window.row_off) * affine.Affine.scale(
+            window.n_cols / buf_shape[1], window.n_rows / buf_shape[0])
+        if not self.is_lazy:
+            # strided views, nothing to read or cache
+            bands = Bands({key: band[window.slices][::step, ::step]
+                           for key, band in self.bands.items()})
+            return self._from_bands(bands, aff=aff)
+        cache_key = (tuple(window), step)
+        if cache_key in self._previews:
+            self._previews.move_to_end(cache_key)
+            return self._previews[cache_key]
+        if build_overviews and step >= 4:
+            try:
+                self.build_overviews()
+            except RuntimeError as e:
+                warnings.warn(f'could not build overviews: {e}')
+        bands = Bands({key: band.read(window, out_shape=buf_shape)
+                       if isinstance(band, LazyBand)
+                       else band[window.slices][::step, ::step]
+                       for key, band in self.bands.items()})
+        preview = self._from_bands(bands, aff=aff)
+        self._previews[cache_key] = preview
+        while len(self._previews) > 4:
+            self._previews.popitem(last=False)
+        return preview
+
+    def preview(self, ax, build_overviews=True):
+        """
+        a decimated raster matched to the pixel size of <ax>, covering
+        only its current extent if autoscaling is off (e.g. zoomed in)
+        """
+        bbox = ax.get_window_extent()
+        out_shape = (max(int(bbox.height), 1), max(int(bbox.width), 1))
+        window = None
+        if not ax.get_autoscale_on():
+            (x_0, x_1), (y_0, y_1) = ax.get_xlim(), ax.get_ylim()
+            window = self.bounds_to_window((min(x_0, x_1), min(y_0, y_1),
+                                            max(x_0, x_1), max(y_0, y_1)))
+            if window.n_rows == 0 or window.n_cols == 0:
+                window = None
+        return self.decimate(out_shape, window=window,
+                             build_overviews=build_overviews)
+
     @property
     def bounds(self):
         """
@@ -274,32 +1268,448 @@ class Raster:
             (x_min, y_min)])
         return box
 
-    def fill_nans(self, val=0):
-        cp = self.copy()
-        for key, band in cp.bands.items():
-            cp.bands[key] = band.fill_nans(val)
-        return cp
+    def bounds_to_window(self, bounds):
+        """
+        the smallest pixel window covering <bounds>, clipped to the raster
+        :param bounds: x_min, y_min, x_max, y_max
+        """
+        x_min, y_min, x_max, y_max = bounds
+        corners = [(x_min, y_min), (x_min, y_max),
+                   (x_max, y_min), (x_max, y_max)]
+        # round off float noise so edges on pixel boundaries don't spill
+        cols, rows = np.round([~self.aff * xy for xy in corners], 6).T
+        row_min = max(int(np.floor(rows.min())), 0)
+        col_min = max(int(np.floor(cols.min())), 0)
+        row_max = min(int(np.ceil(rows.max())), self.N)
+        col_max = min(int(np.ceil(cols.max())), self.M)
+        return Window(row_min, col_min, max(row_max - row_min, 0),
+                      max(col_max - col_min, 0))
+
+    def crop(self, geom, crs=None):
+        """
+        crop to the bounding box of <geom>. only the window is read from
+        lazy rasters, so crop a raster from from_path(path, lazy=True) to
+        pull a small aoi out of a big file. in-memory bands are views.
+        :param geom: bounds tuple (x_min, y_min, x_max, y_max), shapely
+            geometry, or GeoDataFrame/GeoSeries
+        :param crs: crs of <geom> if it differs from the raster's. taken
+            from <geom> if it's a GeoDataFrame/GeoSeries
+        """
+        return self.read_window(self._crop_window(geom, crs))
+
+    def _crop_window(self, geom, crs=None):
+        """
+        the window crop reads, see crop
+        """
+        if hasattr(geom, 'total_bounds'):
+            if crs is None:
+                crs = geom.crs
+            bounds = tuple(geom.total_bounds)
+        elif isinstance(geom, shapely.geometry.base.BaseGeometry):
+            bounds = geom.bounds
+        else:
+            bounds = tuple(geom)
+        if (crs is not None and self.crs is not None
+                and not _same_crs(crs, self.crs)):
+            bounds = rasterio.warp.transform_bounds(
+                _crs_to_wkt(crs), _crs_to_wkt(self.crs), *bounds)
+        window = self.bounds_to_window(bounds)
+        if window.n_rows == 0 or window.n_cols == 0:
+            raise ValueError(f'{bounds} does not overlap raster bounds '
+                             f'{self.bounds}')
+        return window
+
+    def to_path(self, path, dtype=None, compress='DEFLATE', predictor=None,
+                tiled=True, blocksize=DFLT_BLOCK_SIZE, overviews=None,
+                cog=False, options=()):
+        """
+        write to a geotiff, block by block so the whole raster never has to
+        be in memory (lazy rasters stream straight from file to file)
+        :param dtype: defaults to the dtype of the first band
+        :param compress: 'DEFLATE', 'ZSTD', 'LZW' or None
+        :param predictor: 1 (none), 2 (horizontal differencing, for ints)
+            or 3 (floating point). defaults to 2 or 3 when compressing
+        :param tiled: (bool) tiled rather than striped layout
+        :param blocksize: (int) tile edge length in pixels
+        :param overviews: list of decimation factors (e.g. [2, 4, 8]) or
+            'auto' to halve down to about one tile
+        :param cog: (bool) write a cloud optimized geotiff. cogs are always
+            tiled, and get gdal's default overviews unless <overviews> is
+            given (overviews=[] for none)
+        :param options: (list of str) extra gdal creation options
+        """
+        if dtype is None:
+            dtype = self.bands.iloc[0].dtype
+        dtype = np.dtype(dtype)
+        if compress is not None:
+            compress = compress.upper()
+            if compress not in ('DEFLATE', 'ZSTD', 'LZW'):
+                raise ValueError(f'unsupported compression {compress}')
+            if predictor is None:
+                predictor = 3 if np.issubdtype(dtype, np.floating) else 2
+        if overviews == 'auto':
+            overviews, factor = [], 2
+            while max(self.shape) / factor >= blocksize:
+                overviews.append(factor)
+                factor *= 2
+        gtiff_options = ['BIGTIFF=IF_SAFER', *options]
+        if tiled or cog:
+            gtiff_options += ['TILED=YES', f'BLOCKXSIZE={blocksize}',
+                              f'BLOCKYSIZE={blocksize}']
+        if compress is not None:
+            gtiff_options += [f'COMPRESS={compress}', f'PREDICTOR={predictor}']
+
+        # cogs can't be written block by block, so stream to a temporary
+        # tiff and have gdal rewrite it in cog layout
+        gtiff_path = f'{path}.tmp.tif' if cog else path
+        with RasterWriter(gtiff_path, like=self, dtype=dtype,
+                          options=gtiff_options) as writer:
+            block_shape = tuple(
+                min(blocksize * int(np.ceil(b / blocksize)), n)
+                for b, n in zip(self.block_shape, self.shape))
+            for window, block in self.iter_blocks(block_shape):
+                writer.write_window(block, window)
+            if overviews:
+                writer.build_overviews(overviews)
+        if cog:
+            cog_options = [f'BLOCKSIZE={blocksize}', 'BIGTIFF=IF_SAFER']
+            if compress is not None:
+                cog_predictor = {1: 'NO', 2: 'STANDARD',
+                                 3: 'FLOATING_POINT'}[predictor]
+                cog_options += [f'COMPRESS={compress}',
+                                f'PREDICTOR={cog_predictor}']
+            else:
+                # the cog driver would default to lzw
+                cog_options.append('COMPRESS=NONE')
+            if overviews is not None:
+                # the ones built above, or none
+                cog_options.append('OVERVIEWS=FORCE_USE_EXISTING'
+                                   if overviews else 'OVERVIEWS=NONE')
+            try:
+                gdal.Translate(path, gtiff_path, format='COG',
+                               creationOptions=cog_options)
+            finally:
+                gdal.GetDriverByName('GTiff').Delete(gtiff_path)
+
+    def reproject(self, crs=None, resolution=None, resampling='nearest',
+                  bounds=None, path=None, num_threads='ALL_CPUS',
+                  warp_memory=None):
+        """
+        warp all bands to a new crs and/or grid in one gdal pass
+        :param crs: destination crs, defaults to this raster's
+        :param resolution: output pixel size, (x_res, y_res) or one number
+            for both. defaults to gdal's choice
+        :param resampling: gdal resampling method, e.g. 'nearest',
+            'bilinear', 'cubic', 'average', 'mode'
+        :param bounds: output x_min, y_min, x_max, y_max in the
+            destination crs, for warping onto a specific grid
+        :param path: (str) write the result to this (tiled, compressed)
+            geotiff and return it lazily rather than warping into memory
+        :param num_threads: warper threads, an int or 'ALL_CPUS'
+        :param warp_memory: (int) working buffer size in MB. gdal warps in
+            chunks of about this size
+        """
+        if resampling == 'nearest':
+            resampling = 'near'
+        bands = list(self.bands.values())
+        # warp in the bands' dtype, which for lazy bands can differ from
+        # the file's
+        dtype = np.result_type(*(band.dtype for band in bands))
+        src_ds = self._to_gdal()
+        src_nodatas, dst_nodatas = [], []
+        for i, band in enumerate(bands):
+            src_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(
+                src_ds.GetRasterBand(i + 1).DataType)
+            for nodatas, band_dtype in [(src_nodatas, src_dtype),
+                                        (dst_nodatas, dtype)]:
+                if band.nodata is not None:
+                    nodatas.append(str(band.nodata))
+                elif np.issubdtype(band_dtype, np.floating):
+                    nodatas.append('nan')
+                else:
+                    nodatas.append('None')
+        kwargs = dict(
+            dstSRS=_crs_to_wkt(self.crs if crs is None else crs),
+            resampleAlg=resampling, multithread=True,
+            outputType=gdal_array.NumericTypeCodeToGDALTypeCode(dtype),
+            warpOptions=[f'NUM_THREADS={num_threads}'])
+        if resolution is not None:
+            x_res, y_res = np.broadcast_to(resolution, 2)
+            kwargs.update(xRes=abs(x_res), yRes=abs(y_res))
+        if bounds is not None:
+            kwargs['outputBounds'] = tuple(bounds)
+        if set(src_nodatas + dst_nodatas) != {'None'}:
+            # per band
+            kwargs.update(srcNodata=' '.join(src_nodatas),
+                          dstNodata=' '.join(dst_nodatas))
+        if warp_memory is not None:
+            kwargs['warpMemoryLimit'] = warp_memory
+        if path is None:
+            gdal_ds = gdal.Warp('', src_ds, format='MEM', **kwargs)
+            return self._from_gdal(gdal_ds)
+        gdal_ds = gdal.Warp(path, src_ds, format='GTiff',
+                            creationOptions=['TILED=YES', 'COMPRESS=DEFLATE',
+                                             'BIGTIFF=IF_SAFER'],
+                            **kwargs)
+        gdal_ds = None
+        warped = Raster.from_path(path, lazy=True, dtype=None)
+        return self._from_bands(
+            Bands(zip(self.band_names, warped.bands.values())),
+            aff=warped.aff, crs=warped.crs)
+
+    def resample(self, factor=None, resolution=None, resampling='bilinear',
+                 **kwargs):
+        """
+        change the pixel size, keeping the crs
+        :param factor: output pixel size as a multiple of the current one,
+            e.g. 2 halves the number of rows and cols
+        :param resolution: output pixel size, instead of <factor>
+        :param kwargs: passed to reproject
+        """
+        if (factor is None) == (resolution is None):
+            raise ValueError('give one of factor or resolution')
+        if factor is not None:
+            resolution = (abs(self.dx) * factor, abs(self.dy) * factor)
+        return self.reproject(resolution=resolution, resampling=resampling,
+                              bounds=kwargs.pop('bounds', self.bounds),
+                              **kwargs)
+
+    def share(self, path=None):
+        """
+        copy the bands into one shared-memory block (or a memory-mapped
+        file at <path>) that other processes can open w/o pickling pixels:
+            shared = raster.share()
+            executor.submit(work, shared)  # work calls from_shared(shared)
+            ...
+            shared.unlink()
+        :return: SharedRaster, a small picklable description of the block
+        """
+        dtype = np.result_type(*(band.dtype for band in self.bands.values()))
+        shared = SharedRaster(type(self).__name__, self.crs, self.aff,
+                              self.band_names,
+                              [band.nodata for band in self.bands.values()],
+                              dtype.str, (self.n_bands, *self.shape),
+                              path=path)
+        if path is None:
+            shm = shared_memory.SharedMemory(create=True,
+                                             size=max(shared.nbytes, 1))
+            shared.name, shared._shm = shm.name, shm
+            buffer = np.ndarray(shared.shape, dtype=dtype, buffer=shm.buf)
+        else:
+            buffer = np.memmap(path, dtype=dtype, mode='w+',
+                               shape=shared.shape)
+        for i, band in enumerate(self.bands.values()):
+            buffer[i] = band
+        if path is not None:
+            buffer.flush()
+        del buffer
+        return shared
+
+    def from_shared(shared, writeable=False):
+        """
+        a raster (of the type that was shared) whose bands are views into
+        the shared block of <shared>, no copy
+        :param shared: SharedRaster from Raster.share
+        :param writeable: (bool) allow writing to the bands, which other
+            processes will see
+        """
+        if shared.path is None:
+            shm = _attach_shm(shared.name)
+            buffer = np.ndarray(shared.shape, dtype=shared.dtype,
+                                buffer=shm.buf)
+            buffer.flags.writeable = writeable
+            # the bands (and any views of them) keep <buffer> alive, so the
+            # shared memory stays mapped until the last of them is gone
+            weakref.finalize(buffer, shm.close)
+        else:
+            buffer = np.memmap(shared.path, dtype=shared.dtype,
+                               mode='r+' if writeable else 'r',
+                               shape=shared.shape)
+        bands = Bands.from_array(buffer, keys=shared.keys)
+        for band, nodata in zip(bands.values(), shared.nodatas):
+            band.nodata = nodata
+        cls = globals().get(shared.cls_name)
+        if not (isinstance(cls, type) and issubclass(cls, Raster)):
+            raise TypeError(f'{shared.cls_name} is not a raster type')
+        raster = cls.__new__(cls)
+        Raster.__init__(raster, bands=bands, crs=shared.crs, aff=shared.aff)
+        return raster
+
+    def _map_bands(self, op_name, *args, inplace=False, out=None,
+                   executor=None, **kwargs):
+        """
+        apply Band.<op_name> (a method name) to each band
+        :param inplace: (bool) modify this raster's bands
+        :param out: (Raster) write results into this raster's bands
+        :param executor: run the bands in parallel. 'thread' (for ops that
+            release the gil), 'process' (bands are passed through shared
+            memory, not pickled) or a concurrent.futures Executor. None
+            runs them one after another
+        :param kwargs: passed to Band.<op_name>
+        :return: a new raster, or this one / <out>
+        """
+        if executor is not None:
+            return self._map_bands_parallel(op_name, args, kwargs, inplace,
+                                            out, executor)
+        if inplace:
+            for key, band in list(self.bands.items()):
+                if isinstance(band, LazyBand):
+                    # nothing to modify in memory yet
+                    self.bands[key] = getattr(band, op_name)(*args, **kwargs)
+                else:
+                    # bands shared w/ copies are copied first
+                    getattr(self.bands.writable(key), op_name)(
+                        *args, inplace=True, **kwargs)
+            return self
+        if out is None and self.bands.buffer is not None:
+            # keep the result contiguous too
+            out = self._from_bands(Bands.empty(
+                self.band_names, self.shape, dtype=self.bands.buffer.dtype,
+                interleave=self.bands.interleave))
+        if out is None:
+            return self._from_bands(Bands({
+                key: getattr(band, op_name)(*args, **kwargs)
+                for key, band in self.bands.items()}))
+        for band, key in zip(self.bands.values(), out.band_names):
+            getattr(band, op_name)(*args, out=out.bands.writable(key),
+                                   **kwargs)
+        return out
+
+    def _map_bands_parallel(self, op_name, args, kwargs, inplace, out,
+                            executor):
+        """
+        _map_bands w/ an executor. every band gets a destination array up
+        front, then workers fill them
+        """
+        if inplace:
+            out = self
+        elif out is None and self.bands.buffer is not None:
+            out = self._from_bands(Bands.empty(
+                self.band_names, self.shape, dtype=self.bands.buffer.dtype,
+                interleave=self.bands.interleave))
+        elif out is None:
+            out = self._from_bands(Bands({
+                key: Band(np.empty(band.shape, dtype=band.dtype), dtype=None,
+                          copy=False, nodata=band.nodata)
+                for key, band in self.bands.items()}))
+        jobs = []
+        for (key, band), out_key in zip(list(self.bands.items()),
+                                        out.band_names):
+            if inplace and isinstance(band, LazyBand):
+                out.bands[key] = Band(np.empty(band.shape, dtype=band.dtype),
+                                      dtype=None, copy=False,
+                                      nodata=band.nodata)
+            # bands shared w/ copies are copied first
+            dest = out.bands.writable(out_key)
+            if inplace and not isinstance(band, LazyBand):
+                band = dest
+            jobs.append((band, dest))
+        if executor == 'thread':
+            executor, owned = ThreadPoolExecutor(), True
+        elif executor == 'process':
+            executor, owned = ProcessPoolExecutor(), True
+        elif isinstance(executor, Executor):
+            owned = False
+        else:
+            raise ValueError(f'executor must be "thread", "process" or an '
+                             f'Executor, not {executor!r}')
+        try:
+            if isinstance(executor, ProcessPoolExecutor):
+                _map_in_processes(executor, op_name, args, kwargs, jobs)
+            else:
+                list(executor.map(
+                    lambda job: _band_op(*job, op_name, args, kwargs), jobs))
+        finally:
+            if owned:
+                executor.shutdown()
+        return out
+
+    def fill_nans(self, val=0, inplace=False, out=None, executor=None):
+        """
+        :param executor: see _map_bands
+        """
+        return self._map_bands('fill_nans', val, inplace=inplace, out=out,
+                               executor=executor)
 
-    def fill_negs(self, val=0):
-        cp = self.copy()
-        for key, band in cp.bands.items():
-            cp.bands[key] = band.fill_negs(val)
-        return cp
+    def fill_negs(self, val=0, inplace=False, out=None, executor=None):
+        """
+        :param executor: see _map_bands
+        """
+        return self._map_bands('fill_negs', val, inplace=inplace, out=out,
+                               executor=executor)
 
-    def interp(self):
-        interpd = self.copy()
-        for band_name, band in self.bands.items():
-            interpd[band_name] = band.interp()
-        return interpd
+    def interp(self, inplace=False, out=None, executor=None, **kwargs):
+        """
+        :param executor: see _map_bands
+        :param kwargs: see Band.interp
+        """
+        return self._map_bands('interp', inplace=inplace, out=out,
+                               executor=executor, **kwargs)
 
     def pix_to_geo(self, i, j):
-        x, y = self.aff * (j, i)
+        """
+        :param i, j: row, col indices. scalars or arrays
+        """
+        x, y = self.aff * (np.asarray(j), np.asarray(i))
         return x, y
 
-    def geo_to_pix(self, x, y):
-        j, i = (int(np.floor(i)) for i in ~self.aff * (x, y))
+    def _points_xy(self, x, y=None):
+        """
+        coordinate arrays from x, y arrays, or from shapely points /
+        a GeoSeries / a GeoDataFrame passed as <x> (reprojected to this
+        raster's crs if they have a crs)
+        """
+        if y is not None:
+            return np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        points = getattr(x, 'geometry', x)
+        if hasattr(points, 'to_crs'):
+            if points.crs is not None and self.crs is not None:
+                points = points.to_crs(self.crs)
+            return np.asarray(points.x), np.asarray(points.y)
+        if hasattr(points, 'geoms'):
+            points = points.geoms
+        xy = np.array([(point.x, point.y) for point in points],
+                      dtype=float).reshape(-1, 2)
+        return xy[:, 0], xy[:, 1]
+
+    def geo_to_pix(self, x, y=None):
+        """
+        :param x, y: coordinates, scalars or arrays. or pass shapely
+            points / a GeoDataFrame as <x>
+        :return: i, j row, col indices (ints or int arrays)
+        """
+        x, y = self._points_xy(x, y)
+        j, i = ~self.aff * (x, y)
+        i, j = np.floor(i).astype(int), np.floor(j).astype(int)
+        if i.ndim == 0:
+            return int(i), int(j)
         return i, j
 
+    def sample(self, x, y=None):
+        """
+        band values at points. only the window around the points is read
+        from lazy rasters.
+        :param x, y: see geo_to_pix
+        :return: masked array, shape (n_bands, n_points). points outside
+            the raster or on nodata are masked
+        """
+        i, j = (np.atleast_1d(idx) for idx in self.geo_to_pix(x, y))
+        dtype = np.result_type(*(band.dtype for band in self.bands.values()))
+        values = np.ma.masked_all((self.n_bands, *i.shape), dtype=dtype)
+        inside = (i >= 0) & (i < self.N) & (j >= 0) & (j < self.M)
+        if not inside.any():
+            return values
+        i, j = i[inside], j[inside]
+        window = Window(i.min(), j.min(), i.max() - i.min() + 1,
+                        j.max() - j.min() + 1)
+        sub = self.read_window(window)
+        i, j = i - window.row_off, j - window.col_off
+        for b, band in enumerate(sub.bands.values()):
+            vals = Band(np.asarray(band)[i, j], dtype=None, copy=False,
+                        nodata=band.nodata)
+            values[b, inside] = np.ma.masked_array(vals, mask=vals.mask)
+        return values
+
 
 class SingleBand(Raster):
 
@@ -307,7 +1717,7 @@ class SingleBand(Raster):
         super().__init__(bands={0: band}, **kwargs)
 
     def copy(self):
-        return self.__class__(band=self.band, crs=self.crs, aff=self.aff)
+        return self._from_bands(self.bands.copy())
 
     @property
     def bands(self):
@@ -330,8 +1740,8 @@ class SingleBand(Raster):
 
     @band.setter
     def band(self, band):
-        if isinstance(band, np.ndarray):
-            self._bands = Bands({0: Band(band)})
+        if isinstance(band, (np.ndarray, LazyBand)):
+            self._bands = Bands({0: band})
         else:
             raise TypeError(
                 f'band cannot be set w/ instance of type {type(band)}')
@@ -340,34 +1750,88 @@ class SingleBand(Raster):
     def arr(self):
         return super().arr[:, :, 0]
 
+    def sample(self, x, y=None):
+        """
+        band values at points, masked outside the raster and on nodata
+        """
+        return super().sample(x, y)[0]
+
+    def _masked(self):
+        band = self.load().band
+        return np.ma.masked_array(np.asarray(band), mask=band.mask)
+
     def min(self):
-        return np.nanmin(self.arr)
+        return self._masked().min()
 
     def max(self):
-        return np.nanmax(self.arr)
+        return self._masked().max()
 
-    def mk_hill_shade(self, cmap=plt.cm.gist_earth, azimuth=45, zenith=45):
+    def mk_hill_shade(self, cmap=plt.cm.gist_earth, azimuth=315, zenith=45):
+        """
+        rgba image colored by <cmap> and shaded by a light at compass
+        <azimuth> and <zenith> degrees from vertical. cached, so replotting
+        doesn't recompute (see pymagery.terrain)
+        """
         dx, dy = self.dx, self.dy
-        # np.nan will throw things off
-        # temporarily replace w/ min value
-        z = self.fill_nans(self.min()).arr
-        ls = mpl.colors.LightSource(azdeg=315, altdeg=45)
-        hs_arr = ls.shade(z, cmap=cmap, dx=dx, dy=dy)
+        # nodatas are filled (w/ the min value) by terrain.shade, and only
+        # if the result isn't cached already
+        hs_arr = terrain.shade(self.arr, dx=dx, dy=dy, cmap=cmap,
+                               azimuth=azimuth, altitude=90 - zenith,
+                               nodata=self.band.nodata)
         # hs_arr[np.isnan(self.arr)] = np.nan
         return hs_arr
 
+    def terrain(self, products=terrain.PRODUCTS, azimuth=315, altitude=45,
+                block_shape=None, cache=False, path=None):
+        """
+        slope, aspect, hillshade and/or curvature (see pymagery.terrain).
+        lazy rasters, or any raster if <block_shape> or <path> is given, are
+        done block by block w/ a halo, so the dem doesn't have to fit in
+        memory
+        :param products: any of terrain.PRODUCTS
+        :param cache: (bool) memoize in-memory results (they're read-only)
+        :param path: (str) stream block-wise results to this file (a band per
+            product) and return lazy rasters of it, so the results don't
+            have to fit in memory either
+        :return: dict of product name: SingleBand
+        """
+        products = tuple(products)
+        if block_shape is None and path is None and not self.is_lazy:
+            derived = terrain.derive(self.band, self.dx, self.dy, products,
+                                     azimuth, altitude, cache=cache)
+            return {name: self._from_bands(
+                        Bands({0: Band(arr, dtype=None, copy=False)}))
+                    for name, arr in derived.items()}
+
+        def derive_block(block):
+            derived = terrain.derive(block.band, self.dx, self.dy, products,
+                                     azimuth, altitude)
+            return MultiBand(bands=Bands({
+                name: Band(arr, dtype=None, copy=False)
+                for name, arr in derived.items()}),
+                crs=block.crs, aff=block.aff)
+
+        # curvature is a 2nd derivative, so needs 2 pixels of halo
+        out = self.map_blocks(derive_block, block_shape, halo=2, path=path)
+        return {name: self._from_bands(Bands({0: band}))
+                for name, band in zip(products, out.bands.values())}
+
     def plot(self, cbar_fig=None, ax=None, cmap=plt.cm.gist_earth,
-             hs=False, **kwargs):
+             hs=False, full_res=False, **kwargs):
         """
         :param cbar_fig: (plt.figure) supply if you want a colorbar
+        :param full_res: (bool) plot every pixel rather than a version
+            decimated to the resolution of the axes
         :param kwargs:
         :return:
         """
         fig, ax = super().plot(ax=ax)
-        arr = self.arr
+        raster = self if full_res else self.preview(ax)
+        arr = raster.arr
         if hs:
-            arr = self.mk_hill_shade()
-        im = ax.imshow(arr, extent=self.plotting_extent, cmap=cmap, **kwargs)
+            arr = raster.mk_hill_shade()
+        im = ax.imshow(arr, extent=raster.plotting_extent, cmap=cmap,
+                       **kwargs)
         if cbar_fig is not None:
             cbar_fig.colorbar(im, ax=ax, orientation='vertical', fraction=.1)
         return fig, ax
@@ -381,6 +1845,73 @@ class MultiBand(Raster):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
+    def from_array(arr, names=None, interleave='band', crs=None, aff=None):
+        """
+        a MultiBand whose bands are views into the 3d array <arr>, so
+        .arr, .iloc slicing and band-wise ops don't copy.
+        see Bands.from_array
+        """
+        bands = Bands.from_array(arr, keys=names, interleave=interleave)
+        return MultiBand(bands=bands, crs=crs, aff=aff)
+
+    def eval(self, expr, dtype=float, block_shape=None, engine=None):
+        """
+        evaluate band math, e.g. mb.eval('(b8 - b4) / (b8 + b4)'), block by
+        block. only the bands used are read, and the expression is
+        compiled once into a chain of ufuncs that reuse a few block-sized
+        buffers, so there are no full-size temporaries.
+        bands are named by their keys (if they're identifiers) and as
+        b<key>, e.g. b0 for key '0'. sqrt, log, exp, abs, minimum and
+        maximum are available. for float dtypes, pixels that are nodata in
+        any band used are np.nan in the result.
+        :param dtype: dtype of the computation and result. integer dtypes
+            can't use /, sqrt, log or exp, which give floats
+        :param engine: 'numpy', or 'numexpr' (if installed) to have
+            numexpr fuse the ops. defaults to numexpr when it's installed
+        :return: SingleBand
+        """
+        if engine is None:
+            engine = 'numpy' if numexpr is None else 'numexpr'
+        program = _compile_expr(expr)
+        if not program.names:
+            raise ValueError(f'{expr!r} uses no bands')
+        dtype = np.dtype(dtype)
+        if dtype.kind in 'biu' and any(
+                ufunc in _Expr.float_ufuncs
+                for ufunc, _, _ in program.instructions):
+            raise ValueError(f'{expr!r} needs a float dtype (/, sqrt, log '
+                             f'and exp give floats), not {dtype}')
+        names = {}
+        for key in self.band_names:
+            names[f'b{key}'] = key
+            if str(key).isidentifier():
+                names[str(key)] = key
+        missing = program.names - set(names)
+        if missing:
+            raise KeyError(f'no bands named {missing}, bands are '
+                           f'{self.band_names}')
+        keys = {name: names[name] for name in program.names}
+        used = MultiBand(bands=Bands({key: self.bands[key]
+                                      for key in set(keys.values())}),
+                         crs=self.crs, aff=self.aff)
+        result = np.empty(self.shape, dtype=dtype)
+        for window, block in used.iter_blocks(block_shape):
+            arrays = {name: block.bands[key] for name, key in keys.items()}
+            out = result[window.slices]
+            if engine == 'numexpr':
+                numexpr.evaluate(
+                    expr, out=out, casting='unsafe',
+                    local_dict={name: np.asarray(arr, dtype=dtype)
+                                for name, arr in arrays.items()})
+            else:
+                program.evaluate(arrays, dtype, out)
+            for band in block.bands.values():
+                if (dtype.kind == 'f' and band.nodata is not None
+                        and not np.isnan(band.nodata)):
+                    out[band.mask] = np.nan
+        return SingleBand(band=Band(result, dtype=None, copy=False),
+                          crs=self.crs, aff=self.aff)
+
 
 class RGB(MultiBand):
 
@@ -408,19 +1939,804 @@ class RGB(MultiBand):
             return
         if len(bands) not in [3, 4]:
             raise ValueError(f'len input bands is {len(bands)}')
+        if type(bands) is Bands and list(bands) == list('rgba'[:len(bands)]):
+            # already named, e.g. from copy
+            self._bands = bands
+            return
         # rename keys r, g, b
+        if isinstance(bands, Bands):
+            # keep sharing the buffer, and any copy-on-write bands
+            self._bands = bands._renamed('rgba'[:len(bands)])
+            return
         new_bands = Bands()
         rgb_gen = (x for x in 'rgba')
         for val in bands.values():
             new_bands[next(rgb_gen)] = val
         self._bands = new_bands
 
-    def from_path(path):
-        mb = MultiBand.from_path(path)
+    def from_path(path, lazy=False, dtype=float, interleave=None):
+        mb = MultiBand.from_path(path, lazy=lazy, dtype=dtype,
+                                 interleave=interleave)
         rgb = RGB(mb)
         return rgb
 
-    def plot(self, **kwargs):
+    def from_paths(paths, **kwargs):
+        """
+        :param paths: red, green, blue (and optionally alpha) files
+        :param kwargs: passed to Raster.from_paths
+        """
+        mb = MultiBand.from_paths(paths, **kwargs)
+        return RGB(mb)
+
+    def plot(self, full_res=False, **kwargs):
+        """
+        :param full_res: (bool) plot every pixel rather than a version
+            decimated to the resolution of the axes
+        """
         fig, ax = Raster.plot(self, **kwargs)
-        ax.imshow(self.arr[:, :, :3], extent=self.plotting_extent)
+        raster = self if full_res else self.preview(ax)
+        ax.imshow(raster.arr[:, :, :3], extent=raster.plotting_extent)
         return fig, ax
+
+
+class SharedRaster:
+    '''
+    a small, picklable description of a raster whose bands were put in
+    shared memory (or a memory-mapped file) by Raster.share. send it to
+    other processes and open it there w/ Raster.from_shared
+    '''
+
+    def __init__(self, cls_name, crs, aff, keys, nodatas, dtype, shape,
+                 name=None, path=None):
+        """
+        :param shape: (bands, rows, cols) of the band-interleaved block
+        :param name: name of the shared memory block
+        :param path: path of the memory-mapped file, instead of <name>
+        """
+        self.cls_name = cls_name
+        self.crs = crs
+        self.aff = aff
+        self.keys = list(keys)
+        self.nodatas = list(nodatas)
+        self.dtype = dtype
+        self.shape = tuple(shape)
+        self.name = name
+        self.path = path
+        self._shm = None  # handle of the process that made the block
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shm'] = None
+        return state
+
+    def __repr__(self):
+        where = self.path if self.name is None else self.name
+        return f'SharedRaster({self.cls_name}, {self.shape}, {where!r})'
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    def close(self):
+        """
+        close this process's handle on the block. rasters opened w/
+        from_shared keep theirs
+        """
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+    def unlink(self):
+        """
+        free the block (or delete the file). call once, when every process
+        is done w/ it. rasters that are still open keep working
+        """
+        if self.path is not None:
+            os.remove(self.path)
+            return
+        shm = self._shm or _attach_shm(self.name)
+        shm.unlink()
+        shm.close()
+        self._shm = None
+
+
+class RasterStack:
+    '''
+    co-registered rasters over time (e.g. one sentinel scene per date) as a
+    (time, band, y, x) cube. the rasters are usually lazy, and reductions
+    read one block of every date at a time, so stacks of hundreds of scenes
+    don't have to fit in memory.
+    '''
+
+    # finds e.g. 20201002T191229 or 20201002 in a file name
+    date_pattern = r'(\d{8})T?(\d{6})?'
+    # max size (bytes) of the float cube block read by reductions
+    max_block_bytes = 2 ** 28
+
+    def __init__(self, rasters, dates):
+        """
+        :param rasters: rasters on the same grid, w/ the same number of
+            bands. bands are matched by order and named after the first
+            raster's
+        :param dates: one per raster, anything np.datetime64 understands
+        """
+        rasters, dates = list(rasters), list(dates)
+        if len(rasters) != len(dates):
+            raise ValueError(f'got {len(dates)} dates for {len(rasters)} '
+                             f'rasters')
+        if not rasters:
+            raise ValueError('need at least one raster')
+        dates = np.array(dates, dtype='datetime64[s]')
+        order = np.argsort(dates, kind='stable')
+        self.dates = dates[order]
+        self.rasters = [rasters[i] for i in order]
+        _check_grids(self.rasters, [str(date) for date in self.dates])
+        for raster, date in zip(self.rasters, self.dates):
+            if raster.n_bands != self.rasters[0].n_bands:
+                raise ValueError(f'raster at {date} has {raster.n_bands} '
+                                 f'bands, expected {self.n_bands}')
+
+    def from_paths(paths, dates=None, lazy=True, dtype=float):
+        """
+        :param paths: one file per date, or one list of single-band files
+            (see Raster.from_paths) per date
+        :param dates: defaults to dates parsed from the file names (see
+            date_pattern)
+        """
+        paths = list(paths)
+        if dates is None:
+            dates = [parse_date(path if isinstance(path, str) else path[0])
+                     for path in paths]
+
+        def read(path):
+            if isinstance(path, str):
+                return Raster.from_path(path, lazy=lazy, dtype=dtype)
+            return Raster.from_paths(path, lazy=lazy, dtype=dtype)
+
+        return RasterStack([read(path) for path in paths], dates)
+
+    def __repr__(self):
+        return (f'RasterStack({len(self)} dates from {self.dates[0]} to '
+                f'{self.dates[-1]}, shape={self.shape})')
+
+    def __len__(self):
+        return len(self.rasters)
+
+    def __getitem__(self, i):
+        return self.rasters[i]
+
+    @property
+    def band_names(self):
+        return self.rasters[0].band_names
+
+    @property
+    def n_bands(self):
+        return self.rasters[0].n_bands
+
+    @property
+    def shape(self):
+        """
+        (time, band, y, x)
+        """
+        return (len(self), self.n_bands, *self.rasters[0].shape)
+
+    @property
+    def crs(self):
+        return self.rasters[0].crs
+
+    @property
+    def aff(self):
+        return self.rasters[0].aff
+
+    def read_window(self, window, max_workers=None, executor=None):
+        """
+        the (time, band, y, x) float cube of pixel window <window>, w/
+        np.nan on nodata. dates are read concurrently
+        :param executor: (ThreadPoolExecutor) to read w/, e.g. one reused
+            for many windows. otherwise one w/ <max_workers> is made
+        """
+        window = Window(*window)
+
+        def read(raster):
+            return raster.read_window(window).bands.values()
+
+        if executor is None:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                blocks = list(executor.map(read, self.rasters))
+        else:
+            blocks = list(executor.map(read, self.rasters))
+        rows = len(range(*window.slices[0].indices(self.shape[2])))
+        cols = len(range(*window.slices[1].indices(self.shape[3])))
+        cube = np.empty((len(self), self.n_bands, rows, cols))
+        for t, bands in enumerate(blocks):
+            for b, band in enumerate(bands):
+                cube[t, b] = band
+                if band.nodata is not None:
+                    cube[t, b][band.mask] = np.nan
+        return cube
+
+    def __array__(self, dtype=None, copy=None):
+        cube = self.read_window((0, 0, *self.shape[2:]))
+        return cube if dtype is None else cube.astype(dtype)
+
+    def _block_shape(self, block_shape):
+        """
+        block_shape, or the first raster's, shrunk until a float cube block
+        fits in max_block_bytes
+        """
+        if block_shape is not None:
+            return block_shape
+        n_rows, n_cols = self.rasters[0].block_shape
+        pixel_bytes = len(self) * self.n_bands * 8
+        while n_rows * n_cols * pixel_bytes > self.max_block_bytes:
+            if n_rows > 1:
+                n_rows = (n_rows + 1) // 2
+            elif n_cols > 1:
+                n_cols = (n_cols + 1) // 2
+            else:
+                break
+        return n_rows, n_cols
+
+    def iter_blocks(self, block_shape=None, max_workers=None):
+        """
+        :return: generator of (window, cube block)
+        """
+        block_shape = self._block_shape(block_shape)
+        # one pool for all the blocks
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for window in _block_windows(self.shape[2:], block_shape, 0):
+                yield window, self.read_window(window, executor=executor)
+
+    def reduce(self, func, names=None, dtype=float, block_shape=None,
+               max_workers=None):
+        """
+        reduce the cube over time, block by block
+        :param func: (time, band, y, x) cube block -> (band, y, x) array
+        :param names: band names of the result, defaults to band_names
+        :return: raster like the first in the stack
+        """
+        if names is None:
+            names = self.band_names
+        out = np.empty((len(names), *self.shape[2:]), dtype=dtype)
+        for window, cube in self.iter_blocks(block_shape, max_workers):
+            with warnings.catch_warnings():
+                # all-nan pixels are expected, they stay nan
+                warnings.simplefilter('ignore', RuntimeWarning)
+                out[(slice(None), *window.slices)] = func(cube)
+        bands = Bands.from_array(out, keys=names)
+        if len(names) == 1:
+            return SingleBand(band=bands.iloc[0], crs=self.crs, aff=self.aff)
+        if names == self.band_names:
+            return self.rasters[0]._from_bands(bands)
+        return MultiBand(bands=bands, crs=self.crs, aff=self.aff)
+
+    def median(self, **kwargs):
+        """
+        per-pixel median over time of the valid pixels (a median composite)
+        :param kwargs: passed to reduce
+        """
+        return self.reduce(lambda cube: np.nanmedian(cube, axis=0),
+                           **kwargs)
+
+    def count_valid(self, **kwargs):
+        """
+        per-pixel count of dates that aren't nodata
+        """
+        return self.reduce(lambda cube: (~np.isnan(cube)).sum(axis=0),
+                           dtype=np.int64, **kwargs)
+
+    def max_ndvi(self, nir, red, **kwargs):
+        """
+        composite of, at each pixel, the date w/ the highest ndvi (e.g. the
+        least cloudy). np.nan where no date has a valid ndvi
+        :param nir, red: band names
+        """
+        i_nir = self.band_names.index(nir)
+        i_red = self.band_names.index(red)
+
+        def composite(cube):
+            nir_arr, red_arr = cube[:, i_nir], cube[:, i_red]
+            ndvi = (nir_arr - red_arr) / (nir_arr + red_arr)
+            valid = np.isfinite(ndvi)
+            best = np.where(valid, ndvi, -np.inf).argmax(axis=0)
+            out = np.take_along_axis(cube, best[None, None], axis=0)[0]
+            out[:, ~valid.any(axis=0)] = np.nan
+            return out
+
+        return self.reduce(composite, **kwargs)
+
+
+def parse_date(path, pattern=RasterStack.date_pattern):
+    """
+    the date (and time, if there is one) in a file name, e.g.
+    T10TFT_20201002T191229_B08_10m.jp2 -> 2020-10-02T19:12:29
+    :return: np.datetime64
+    """
+    match = re.search(pattern, os.path.basename(path))
+    if match is None:
+        raise ValueError(f'no date in {path}')
+    day, time = match.groups()[:2]
+    iso = f'{day[:4]}-{day[4:6]}-{day[6:]}'
+    if time:
+        iso += f'T{time[:2]}:{time[2:4]}:{time[4:]}'
+    return np.datetime64(iso, 's')
+
+
+def _crs_to_wkt(crs):
+    """
+    anything osr understands (epsg:xxxx, proj4, wkt) -> wkt
+    """
+    srs = osr.SpatialReference()
+    srs.SetFromUserInput(str(crs))
+    return srs.ExportToWkt()
+
+
+def _check_grids(rasters, names):
+    """
+    raise ValueError unless all <rasters> share shape, aff and crs
+    """
+    first, first_name = rasters[0], names[0]
+    for raster, name in zip(rasters[1:], names[1:]):
+        if raster.shape != first.shape:
+            raise ValueError(f'shape of {name} {raster.shape} != '
+                             f'shape of {first_name} {first.shape}')
+        if (raster.aff is not None and first.aff is not None
+                and not raster.aff.almost_equals(first.aff)):
+            raise ValueError(f'aff of {name} {raster.aff} != '
+                             f'aff of {first_name} {first.aff}')
+        if (raster.crs is not None and first.crs is not None
+                and not _same_crs(raster.crs, first.crs)):
+            raise ValueError(f'crs of {name} != crs of {first_name}')
+
+
+def _stack_single_bands(rasters, names):
+    """
+    one MultiBand of single-band <rasters> that share a grid
+    """
+    _check_grids(rasters, names)
+    bands = Bands()
+    for name, raster in zip(names, rasters):
+        if raster.n_bands != 1:
+            raise ValueError(
+                f'{name} has {raster.n_bands} bands, expected 1')
+        bands[name] = raster.iloc[0]
+    return MultiBand(bands=bands, crs=rasters[0].crs, aff=rasters[0].aff)
+
+
+def _band_op(band, out, method, args, kwargs):
+    """
+    band.<method>(*args, **kwargs), written into <out> (or in place, if
+    <out> is <band>)
+    """
+    if band is out:
+        getattr(band, method)(*args, inplace=True, **kwargs)
+    else:
+        getattr(band, method)(*args, out=out, **kwargs)
+
+
+def _attach_shm(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 always tracks. pool workers share the parent's
+        # resource tracker, so this just registers the same name again
+        return shared_memory.SharedMemory(name=name)
+
+
+def _shm_band_op(band, name, shape, dtype, nodata, method, args, kwargs):
+    """
+    worker for _map_in_processes: run the op on the band in shared memory
+    <name>, in place. or if <band> is a LazyBand, read it into there
+    """
+    shm = _attach_shm(name)
+    arr = Band(np.ndarray(shape, dtype=dtype, buffer=shm.buf), dtype=None,
+               copy=False, nodata=nodata)
+    try:
+        _band_op(arr if band is None else band, arr, method, args, kwargs)
+    finally:
+        del arr
+        try:
+            shm.close()
+        except BufferError:
+            # a traceback still holds a view, it's closed w/ the process
+            pass
+
+
+def _map_in_processes(executor, method, args, kwargs, jobs):
+    """
+    run (band, out) <jobs> on a process pool. bands go to the workers and
+    back through shared memory, lazy bands are read by the workers
+    """
+    shms = []
+    try:
+        futures = []
+        for band, out in jobs:
+            shm = shared_memory.SharedMemory(create=True,
+                                             size=max(out.nbytes, 1))
+            shms.append(shm)
+            payload = band
+            if not isinstance(band, LazyBand):
+                np.ndarray(out.shape, dtype=out.dtype,
+                           buffer=shm.buf)[...] = band
+                payload = None
+            futures.append(executor.submit(
+                _shm_band_op, payload, shm.name, out.shape, out.dtype.str,
+                band.nodata, method, args, kwargs))
+        for (band, out), shm, future in zip(jobs, shms, futures):
+            future.result()
+            out[...] = np.ndarray(out.shape, dtype=out.dtype,
+                                  buffer=shm.buf)
+            out.nodata = band.nodata
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+
+# limits on the gdal reads of the async methods
+_io_limits = {'max_workers': 8, 'max_concurrency': 8}
+_io_executor = None
+_io_semaphores = weakref.WeakKeyDictionary()
+
+
+def set_io_limits(max_workers=None, max_concurrency=None):
+    """
+    :param max_workers: (int) threads that run gdal reads for the async
+        methods (Raster.afrom_path etc.)
+    :param max_concurrency: (int) max reads in flight per event loop. more
+        wait their turn w/o tying up a thread
+    """
+    global _io_executor
+    if max_workers is not None:
+        _io_limits['max_workers'] = max_workers
+        if _io_executor is not None:
+            _io_executor.shutdown(wait=False)
+            _io_executor = None
+    if max_concurrency is not None:
+        _io_limits['max_concurrency'] = max_concurrency
+        _io_semaphores.clear()
+
+
+async def _run_io(func, *args, **kwargs):
+    """
+    await func(*args, **kwargs) run on the io executor
+    """
+    global _io_executor
+    loop = asyncio.get_running_loop()
+    if loop not in _io_semaphores:
+        _io_semaphores[loop] = asyncio.Semaphore(
+            _io_limits['max_concurrency'])
+    if _io_executor is None:
+        _io_executor = ThreadPoolExecutor(
+            max_workers=_io_limits['max_workers'],
+            thread_name_prefix='pymagery-io')
+    async with _io_semaphores[loop]:
+        return await loop.run_in_executor(
+            _io_executor, partial(func, *args, **kwargs))
+
+
+def _same_crs(crs_a, crs_b):
+    if crs_a is None or crs_b is None:
+        return crs_a is crs_b
+    srs_a, srs_b = osr.SpatialReference(), osr.SpatialReference()
+    srs_a.SetFromUserInput(str(crs_a))
+    srs_b.SetFromUserInput(str(crs_b))
+    return bool(srs_a.IsSame(srs_b))
+
+
+class RasterWriter:
+    '''
+    writes a raster to disk one window at a time, so the whole thing never
+    has to be in memory:
+
+    with RasterWriter(path, like=raster) as writer:
+        for window, block in raster.iter_blocks(halo=1):
+            writer.write_window(process(block), window)
+    '''
+
+    def __init__(self, path, like, n_bands=None, dtype=np.float64,
+                 nodata=None, driver='GTiff', options=()):
+        """
+        :param like: (Raster) output has this shape, crs and aff
+        :param n_bands: (int) defaults to like.n_bands
+        :param nodata: defaults to the nodata of like's first band
+        :param options: (list of str) gdal creation options
+        """
+        if n_bands is None:
+            n_bands = like.n_bands
+        if nodata is None:
+            nodata = getattr(like.bands.iloc[0], 'nodata', None)
+        gdal_type = gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dtype))
+        self.path = path
+        self.ds = gdal.GetDriverByName(driver).Create(
+            path, like.M, like.N, n_bands, gdal_type, options=list(options))
+        if like.aff is not None:
+            self.ds.SetGeoTransform(like.aff.to_gdal())
+        if like.crs is not None:
+            self.ds.SetProjection(_crs_to_wkt(like.crs))
+        if nodata is not None:
+            for i in range(n_bands):
+                self.ds.GetRasterBand(i + 1).SetNoDataValue(float(nodata))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write_window(self, raster, window):
+        """
+        write <raster> to the file at <window>, dropping any halo
+        """
+        raster = window.trim(raster)
+        for i, band in enumerate(raster.bands.values()):
+            self.ds.GetRasterBand(i + 1).WriteArray(
+                np.asarray(band), window.col_off, window.row_off)
+
+    def build_overviews(self, levels, resampling='AVERAGE'):
+        """
+        build internal overviews, once all windows are written
+        :param levels: decimation factors, e.g. [2, 4, 8]
+        """
+        self.ds.BuildOverviews(resampling, list(levels))
+
+    def close(self):
+        if self.ds is not None:
+            self.ds.FlushCache()
+            self.ds = None
+
+
+def _window_bounds(raster, window):
+    """
+    geo bounds (x_min, y_min, x_max, y_max) of a pixel window of <raster>
+    """
+    xs, ys = raster.pix_to_geo(
+        np.array([window.row_off, window.row_off + window.n_rows]),
+        np.array([window.col_off, window.col_off + window.n_cols]))
+    return xs.min(), ys.min(), xs.max(), ys.max()
+
+
+def _read_ahead(executor, func, items, n_ahead):
+    """
+    like executor.map(func, items), but w/ at most <n_ahead> calls submitted
+    and not yet consumed, so results don't pile up in memory faster than
+    they're used
+    """
+    pending = deque()
+    for item in items:
+        if len(pending) >= n_ahead:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def _mosaic_piece(raster, out, resampling):
+    """
+    the part of <raster> that overlaps mosaic <out>, on out's grid
+    :return: (window into out, list of float arrays w/ nan nodata) or None
+    """
+    bounds = raster.bounds
+    if not _same_crs(raster.crs, out.crs):
+        bounds = rasterio.warp.transform_bounds(
+            _crs_to_wkt(raster.crs), _crs_to_wkt(out.crs), *bounds)
+    out_window = out.bounds_to_window(bounds)
+    if out_window.n_rows == 0 or out_window.n_cols == 0:
+        return None
+    out_bounds = _window_bounds(out, out_window)
+    cols, rows = ~raster.aff * (out.aff.c, out.aff.f)
+    aligned = (_same_crs(raster.crs, out.crs)
+               and np.isclose(raster.dx, out.dx)
+               and np.isclose(raster.dy, out.dy)
+               and np.isclose(cols, np.round(cols))
+               and np.isclose(rows, np.round(rows)))
+    if aligned:
+        # same grid, just read the overlapping window
+        piece = raster.read_window(Window(
+            out_window.row_off + int(np.round(rows)),
+            out_window.col_off + int(np.round(cols)), *out_window.shape))
+    else:
+        # warp just the part under out_bounds, w/ a margin for the
+        # resampling kernel, rather than copying the whole input
+        try:
+            window = raster._crop_window(out_bounds, crs=out.crs)
+        except ValueError:
+            return None
+        margin = 4
+        row_min = max(window.row_off - margin, 0)
+        col_min = max(window.col_off - margin, 0)
+        row_max = min(window.row_off + window.n_rows + margin, raster.N)
+        col_max = min(window.col_off + window.n_cols + margin, raster.M)
+        raster = raster.read_window(Window(row_min, col_min,
+                                           row_max - row_min,
+                                           col_max - col_min))
+        piece = raster.reproject(out.crs, resolution=(out.dx, out.dy),
+                                 resampling=resampling, bounds=out_bounds)
+    if piece.shape != out_window.shape:
+        raise ValueError(f'could not put {raster} on the mosaic grid')
+    arrs = []
+    for band in piece.bands.values():
+        band = band.read() if isinstance(band, LazyBand) else band
+        arrs.append(np.where(band.mask, np.nan, band).astype(float))
+    return out_window, arrs
+
+
+def mosaic(rasters, method='first', bounds=None, resolution=None,
+           resampling='nearest', max_workers=None):
+    """
+    merge rasters onto one grid, reading only the part of each one that
+    overlaps the output. inputs on the output grid are read directly,
+    others are reprojected onto it.
+    :param rasters: rasters and/or paths (opened lazily). they must have
+        the same number of bands. the first one sets the type, crs and
+        band names of the output
+    :param method: where inputs overlap, keep the 'first' or 'last' valid
+        value, or the 'min', 'max' or 'mean' of valid values
+    :param bounds: output x_min, y_min, x_max, y_max. defaults to the union
+        of the inputs
+    :param resolution: output pixel size, defaults to the first raster's
+    :param resampling: used for inputs that aren't on the output grid
+    :param max_workers: (int) threads reading inputs ahead of the merge.
+        at most this many inputs are read ahead
+    :return: float raster w/ np.nan where no input has data
+    """
+    if method not in ('first', 'last', 'min', 'max', 'mean'):
+        raise ValueError(f'unknown mosaic method {method!r}')
+    rasters = [Raster.from_path(raster, lazy=True)
+               if isinstance(raster, str) else raster for raster in rasters]
+    first = rasters[0]
+    if resolution is None:
+        resolution = (first.dx, first.dy)
+    x_res, y_res = (abs(res) for res in np.broadcast_to(resolution, 2))
+    if bounds is None:
+        all_bounds = [raster.bounds if _same_crs(raster.crs, first.crs)
+                      else rasterio.warp.transform_bounds(
+                          _crs_to_wkt(raster.crs), _crs_to_wkt(first.crs),
+                          *raster.bounds)
+                      for raster in rasters]
+        x_mins, y_mins, x_maxs, y_maxs = zip(*all_bounds)
+        bounds = min(x_mins), min(y_mins), max(x_maxs), max(y_maxs)
+    x_min, y_min, x_max, y_max = bounds
+    # snap to the first raster's grid, so it can be read w/o resampling
+    x_0, y_0 = first.aff.c, first.aff.f
+    x_min = x_0 + np.floor(np.round((x_min - x_0) / x_res, 6)) * x_res
+    y_max = y_0 + np.ceil(np.round((y_max - y_0) / y_res, 6)) * y_res
+    shape = (int(np.ceil(np.round((y_max - y_min) / y_res, 6))),
+             int(np.ceil(np.round((x_max - x_min) / x_res, 6))))
+    aff = affine.Affine(x_res, 0, x_min, 0, -y_res, y_max)
+    out = first._from_bands(
+        Bands({key: Band(np.full(shape, np.nan), dtype=None, copy=False)
+               for key in first.band_names}), aff=aff)
+    counts = None
+    if method == 'mean':
+        counts = np.zeros((out.n_bands, *shape), dtype=np.uint32)
+
+    if max_workers is None:
+        # ThreadPoolExecutor's default
+        max_workers = min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # reads ahead in parallel but yields in input order, which
+        # first/last depend on
+        pieces = _read_ahead(
+            executor, partial(_mosaic_piece, out=out, resampling=resampling),
+            rasters, max_workers)
+        for piece in pieces:
+            if piece is None:
+                continue
+            window, arrs = piece
+            if len(arrs) != out.n_bands:
+                raise ValueError(f'mosaic inputs need {out.n_bands} bands, '
+                                 f'got {len(arrs)}')
+            for band, arr in zip(out.bands.values(), arrs):
+                current = band[window.slices]
+                if method == 'first':
+                    np.copyto(current, arr, where=np.isnan(current))
+                elif method == 'last':
+                    np.copyto(current, arr, where=~np.isnan(arr))
+                elif method == 'min':
+                    np.fmin(current, arr, out=current)
+                elif method == 'max':
+                    np.fmax(current, arr, out=current)
+                else:
+                    np.copyto(current, 0, where=np.isnan(current)
+                              & ~np.isnan(arr))
+                    np.add(current, arr, out=current,
+                           where=~np.isnan(arr))
+            if counts is not None:
+                for count, arr in zip(counts, arrs):
+                    count[window.slices] += ~np.isnan(arr)
+    if counts is not None:
+        for band, count in zip(out.bands.values(), counts):
+            np.divide(band, count, out=band, where=count > 0)
+    return out
+
+
+class _Expr:
+    '''
+    band math compiled to a list of ufunc calls. intermediate results go in
+    a few block-sized buffers ("registers") that are reused between ops
+    '''
+
+    ops = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply,
+           ast.Div: np.true_divide, ast.Pow: np.power}
+    funcs = {'sqrt': np.sqrt, 'log': np.log, 'exp': np.exp, 'abs': np.abs,
+             'minimum': np.minimum, 'maximum': np.maximum}
+    # ops w/o integer results
+    float_ufuncs = {np.true_divide, np.sqrt, np.log, np.exp}
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.names = set()
+        self.instructions = []  # (ufunc, operands, out register)
+        self.n_registers = 0
+        self._free = []
+        tree = ast.parse(expr, mode='eval')
+        self.result = self._compile(tree.body)
+
+    def _register(self):
+        if self._free:
+            return self._free.pop()
+        self.n_registers += 1
+        return ('reg', self.n_registers - 1)
+
+    def _emit(self, ufunc, operands):
+        # write into the first register operand, free the others
+        regs = [op for op in operands if op[0] == 'reg']
+        out = regs[0] if regs else self._register()
+        self._free.extend(regs[1:])
+        self.instructions.append((ufunc, operands, out))
+        return out
+
+    def _compile(self, node):
+        if isinstance(node, ast.Name):
+            if node.id in self.funcs:
+                raise ValueError(f'{node.id} is a function, not a band')
+            self.names.add(node.id)
+            return ('name', node.id)
+        if isinstance(node, ast.Constant) and isinstance(
+                node.value, (int, float)):
+            return ('const', node.value)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.UAdd):
+            return self._compile(node.operand)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return self._emit(np.negative, [self._compile(node.operand)])
+        if isinstance(node, ast.BinOp) and type(node.op) in self.ops:
+            return self._emit(self.ops[type(node.op)],
+                              [self._compile(node.left),
+                               self._compile(node.right)])
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+                and node.func.id in self.funcs and not node.keywords):
+            return self._emit(self.funcs[node.func.id],
+                              [self._compile(arg) for arg in node.args])
+        raise ValueError(f'unsupported expression: {ast.dump(node)}')
+
+    def evaluate(self, arrays, dtype, out):
+        """
+        :param arrays: dict of name: array
+        :param out: array the result is written into
+        """
+        registers = [np.empty(out.shape, dtype=dtype)
+                     for _ in range(self.n_registers)]
+
+        def value(operand):
+            kind, val = operand
+            if kind == 'name':
+                return arrays[val]
+            if kind == 'reg':
+                return registers[val]
+            return val
+
+        for n, (ufunc, operands, reg) in enumerate(self.instructions):
+            # the last op writes straight into <out>
+            target = out if n == len(self.instructions) - 1 else value(reg)
+            # bands are cast to <dtype>, like numexpr's inputs
+            ufunc(*(value(op) for op in operands), out=target, dtype=dtype,
+                  casting='unsafe')
+        if not self.instructions:
+            out[...] = value(self.result)
+        return out
+
+
+@lru_cache(maxsize=128)
+def _compile_expr(expr):
+    return _Expr(expr)
@@ -0,0 +1,124 @@
+"""
+process-wide cache of open gdal datasets and decoded pixels, so reading the
+same files over and over doesn't re-open and re-decode them. entries are
+dropped when a file's mtime or size changes.
+
+caching pixels is off by default, set MAX_BYTES to turn it on:
+    pymagery.cache.MAX_BYTES = 2 ** 30
+"""
+import os
+import threading
+from collections import OrderedDict
+from osgeo import gdal
+
+# budget (bytes) for decoded pixels, 0 to not cache pixels
+MAX_BYTES = 0
+# max number of open datasets, 0 to not cache datasets
+MAX_DATASETS = 64
+
+_lock = threading.RLock()
+_datasets = OrderedDict()
+_arrays = OrderedDict()
+_nbytes = 0
+_stats = dict.fromkeys(['hits', 'misses', 'evictions', 'dataset_hits',
+                        'dataset_misses'], 0)
+
+
+def _stamp(path):
+    """
+    (mtime, size) of a local file, None for anything else (e.g. /vsicurl/)
+    """
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError, ValueError):
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def open_dataset(path):
+    """
+    gdal.Open(path), cached. datasets aren't thread safe, so each thread
+    gets its own
+    """
+    if not MAX_DATASETS:
+        return gdal.Open(path)
+    key = (path, threading.get_ident())
+    stamp = _stamp(path)
+    with _lock:
+        if key in _datasets and _datasets[key][0] == stamp:
+            _datasets.move_to_end(key)
+            _stats['dataset_hits'] += 1
+            return _datasets[key][1]
+        _stats['dataset_misses'] += 1
+    ds = gdal.Open(path)
+    with _lock:
+        _datasets[key] = (stamp, ds)
+        _datasets.move_to_end(key)
+        while len(_datasets) > MAX_DATASETS:
+            _datasets.popitem(last=False)
+    return ds
+
+
+def read(path, key, func):
+    """
+    func() (which decodes pixels of <path>) memoized on <path> and <key>
+    (e.g. band, window). cached arrays are read-only, copy them before
+    changing them
+    """
+    global _nbytes
+    if not MAX_BYTES:
+        return func()
+    full_key = (path, key)
+    stamp = _stamp(path)
+    with _lock:
+        if full_key in _arrays and _arrays[full_key][0] == stamp:
+            _arrays.move_to_end(full_key)
+            _stats['hits'] += 1
+            return _arrays[full_key][1]
+        _stats['misses'] += 1
+    arr = func()
+    if arr.nbytes > MAX_BYTES:
+        return arr
+    arr.flags.writeable = False
+    with _lock:
+        if full_key in _arrays:
+            _nbytes -= _arrays.pop(full_key)[1].nbytes
+        _arrays[full_key] = (stamp, arr)
+        _nbytes += arr.nbytes
+        while _nbytes > MAX_BYTES:
+            _, (_, evicted) = _arrays.popitem(last=False)
+            _nbytes -= evicted.nbytes
+            _stats['evictions'] += 1
+    return arr
+
+
+def forget(path):
+    """
+    drop everything cached for <path>, e.g. after building overviews
+    """
+    global _nbytes
+    with _lock:
+        for key in [key for key in _datasets if key[0] == path]:
+            del _datasets[key]
+        for key in [key for key in _arrays if key[0] == path]:
+            _nbytes -= _arrays.pop(key)[1].nbytes
+
+
+def clear():
+    global _nbytes
+    with _lock:
+        _datasets.clear()
+        _arrays.clear()
+        _nbytes = 0
+        for key in _stats:
+            _stats[key] = 0
+
+
+def stats():
+    """
+    :return: dict of hits, misses, evictions (of pixels), dataset_hits,
+        dataset_misses, nbytes (of pixels cached), n_arrays, n_datasets
+    """
+    with _lock:
+        return dict(_stats, nbytes=_nbytes, n_arrays=len(_arrays),
+                    n_datasets=len(_datasets))
@@ -0,0 +1,216 @@
+"""
+opt-in timing of pymagery's hot paths (reads, band ops, stacking, copies,
+plotting). nothing is wrapped until enable() or record() is called, and
+disable() puts the original functions back, so it costs nothing when off.
+
+    with instrument.record() as events:
+        sb = pymagery.Raster.from_path(path)
+        sb.fill_nans(0)
+    instrument.summary(events)
+
+or forward every event to a metrics system:
+
+    instrument.add_hook(lambda event: statsd.timing(event['name'], ...))
+    instrument.enable()
+
+each event is a dict of:
+    name: e.g. 'Band.fill_nans'
+    seconds: wall time, including nested ops
+    bytes_read: pixels decoded from files, including nested ops
+    bytes_allocated: bytes of new arrays returned (not views of inputs)
+    copies: number of new arrays returned
+    depth: nesting level, 0 for ops called directly
+    thread: thread id
+"""
+import time
+import threading
+from collections import UserDict
+from contextlib import contextmanager
+from functools import wraps
+import numpy as np
+
+import pymagery
+
+# (class name, attribute, whether it reads from disk)
+HOT_PATHS = [
+    ('Raster', 'from_path', True),
+    ('Raster', 'from_paths', False),
+    ('LazyBand', 'read', True),
+    ('Raster', 'load', False),
+    ('Raster', 'read_window', False),
+    ('Band', '__new__', False),
+    ('Band', 'fill_nans', False),
+    ('Band', 'fill_negs', False),
+    ('Band', 'interp', False),
+    ('Raster', '_map_bands', False),
+    ('Bands', 'stack', False),
+    ('Raster', 'arr', False),
+    ('SingleBand', 'arr', False),
+    ('Raster', 'copy', False),
+    ('SingleBand', 'copy', False),
+    ('Raster', 'to_path', False),
+    ('Raster', 'decimate', False),
+    ('Raster', 'plot', False),
+    ('SingleBand', 'plot', False),
+    ('RGB', 'plot', False),
+    ('SingleBand', 'mk_hill_shade', False),
+]
+
+_lock = threading.RLock()
+_local = threading.local()
+_hooks = []
+_originals = []  # (class, attribute, original class __dict__ value)
+_n_enabled = 0
+
+
+def add_hook(hook):
+    """
+    :param hook: called w/ each event dict, on the thread that ran the op
+    """
+    with _lock:
+        _hooks.append(hook)
+
+
+def remove_hook(hook):
+    with _lock:
+        _hooks.remove(hook)
+
+
+def is_enabled():
+    return _n_enabled > 0
+
+
+def enable():
+    """
+    wrap the HOT_PATHS. calls nest, each enable() needs a disable()
+    """
+    global _n_enabled
+    with _lock:
+        _n_enabled += 1
+        if _n_enabled > 1:
+            return
+        for cls_name, attr, reads in HOT_PATHS:
+            cls = getattr(pymagery, cls_name)
+            original = cls.__dict__[attr]
+            _originals.append((cls, attr, original))
+            setattr(cls, attr, _wrap(original, f'{cls_name}.{attr}', reads))
+
+
+def disable():
+    """
+    undo enable(), restoring the original functions
+    """
+    global _n_enabled
+    with _lock:
+        if _n_enabled == 0:
+            return
+        _n_enabled -= 1
+        if _n_enabled > 0:
+            return
+        while _originals:
+            cls, attr, original = _originals.pop()
+            setattr(cls, attr, original)
+
+
+@contextmanager
+def record():
+    """
+    enable instrumentation while in the block
+    :return: list that events (from all threads) are appended to
+    """
+    events = []
+    add_hook(events.append)
+    enable()
+    try:
+        yield events
+    finally:
+        disable()
+        remove_hook(events.append)
+
+
+def summary(events, depth=None):
+    """
+    :param depth: only count events at this nesting level, e.g. 0 to not
+        double count nested ops. all events by default
+    :return: dict of name: dict of count and summed metrics
+    """
+    totals = {}
+    for event in events:
+        if depth is not None and event['depth'] != depth:
+            continue
+        total = totals.setdefault(event['name'], {
+            'count': 0, 'seconds': 0.0, 'bytes_read': 0,
+            'bytes_allocated': 0, 'copies': 0})
+        total['count'] += 1
+        for key in ['seconds', 'bytes_read', 'bytes_allocated', 'copies']:
+            total[key] += event[key]
+    return totals
+
+
+def _arrays(obj):
+    """
+    arrays in <obj> (an array, raster, bands or a sequence of them)
+    """
+    if isinstance(obj, np.ndarray):
+        return [obj]
+    if isinstance(obj, pymagery.Raster):
+        obj = obj.bands
+    if isinstance(obj, (dict, UserDict)):
+        obj = list(obj.values())
+    if isinstance(obj, (list, tuple)):
+        # one level deep, e.g. not into lists of paths
+        return [arr for item in obj if not isinstance(item, (list, tuple))
+                for arr in _arrays(item)]
+    return []
+
+
+def _new_arrays(result, args, kwargs):
+    """
+    arrays in <result> that don't share memory w/ the inputs
+    """
+    inputs = _arrays(list(args) + list(kwargs.values()))
+    return [arr for arr in _arrays(result)
+            if not isinstance(arr, np.memmap)
+            and not any(np.may_share_memory(arr, inp) for inp in inputs)]
+
+
+def _wrap(original, name, reads):
+    """
+    a version of class attribute <original> (function, staticmethod or
+    property) that reports events
+    """
+    if isinstance(original, staticmethod):
+        return staticmethod(_wrap_func(original.__func__, name, reads))
+    if isinstance(original, property):
+        return property(_wrap_func(original.fget, name, reads),
+                        original.fset, original.fdel, original.__doc__)
+    return _wrap_func(original, name, reads)
+
+
+def _wrap_func(func, name, reads):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        event = {'name': name, 'bytes_read': 0, 'depth': len(stack),
+                 'thread': threading.get_ident()}
+        stack.append(event)
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            event['seconds'] = time.perf_counter() - start
+            stack.pop()
+        new = _new_arrays(result, args, kwargs)
+        event['bytes_allocated'] = sum(arr.nbytes for arr in new)
+        event['copies'] = len(new)
+        if reads:
+            event['bytes_read'] = max(event['bytes_read'],
+                                      event['bytes_allocated'])
+        if stack:
+            stack[-1]['bytes_read'] += event['bytes_read']
+        for hook in list(_hooks):
+            hook(event)
+        return result
+    return wrapper
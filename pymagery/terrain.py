@@ -0,0 +1,174 @@
+"""
+terrain derivatives of dems (slope, aspect, hillshade, curvature) from a
+single gradient pass, w/ a small cache so repeated plotting is free
+"""
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import matplotlib as mpl
+import matplotlib.colors
+
+PRODUCTS = ('slope', 'aspect', 'hillshade', 'curvature')
+
+# max number of cached results
+CACHE_SIZE = 8
+_cache = OrderedDict()
+
+
+def clear_cache():
+    _cache.clear()
+
+
+def _fingerprint(z):
+    """
+    hash of the contents of array <z>, for cache keys
+    """
+    z = np.ascontiguousarray(z)
+    digest = hashlib.blake2b(z.view(np.uint8).reshape(-1), digest_size=16)
+    return z.shape, z.dtype.str, digest.hexdigest()
+
+
+def _cached(key, func):
+    """
+    func() memoized on <key>. results are made read-only so they can't be
+    changed under the cache
+    """
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+    result = func()
+    arrs = result.values() if isinstance(result, dict) else [result]
+    for arr in arrs:
+        arr.flags.writeable = False
+    _cache[key] = result
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return result
+
+
+def gradients(z, dx=1, dy=-1):
+    """
+    :param dx, dy: pixel size, as in a raster's aff (dy is negative for
+        north-up rasters)
+    :return: dz/dx (eastward) and dz/dy (northward)
+    """
+    dz_drow, dz_dcol = np.gradient(np.asarray(z, dtype=float), dy, dx)
+    return dz_dcol, dz_drow
+
+
+def slope(dz_dx, dz_dy):
+    """
+    degrees from horizontal
+    """
+    return np.degrees(np.arctan(np.hypot(dz_dx, dz_dy)))
+
+
+def aspect(dz_dx, dz_dy):
+    """
+    compass direction (degrees clockwise from north) that the slope
+    faces. np.nan where it's flat
+    """
+    asp = np.degrees(np.arctan2(-dz_dx, -dz_dy)) % 360
+    asp[(dz_dx == 0) & (dz_dy == 0)] = np.nan
+    return asp
+
+
+def illumination(dz_dx, dz_dy, azimuth=315, altitude=45):
+    """
+    cosine of the angle between the surface normal and a light at compass
+    <azimuth> and <altitude> degrees above the horizon
+    """
+    az, alt = np.radians(azimuth), np.radians(altitude)
+    norm = np.sqrt(dz_dx ** 2 + dz_dy ** 2 + 1)
+    return (-dz_dx * np.sin(az) * np.cos(alt)
+            - dz_dy * np.cos(az) * np.cos(alt)
+            + np.sin(alt)) / norm
+
+
+def hillshade(dz_dx, dz_dy, azimuth=315, altitude=45):
+    """
+    0 (shadow) to 1 (facing the light)
+    """
+    return np.clip(illumination(dz_dx, dz_dy, azimuth, altitude), 0, 1)
+
+
+def curvature(dz_dx, dz_dy, dx=1, dy=-1):
+    """
+    negative laplacian of elevation: positive on convex ground (ridges),
+    negative on concave ground (valleys)
+    """
+    return -(np.gradient(dz_dx, dx, axis=1) + np.gradient(dz_dy, dy, axis=0))
+
+
+def derive(z, dx=1, dy=-1, products=PRODUCTS, azimuth=315, altitude=45,
+           cache=False):
+    """
+    the requested terrain products, sharing one gradient pass
+    :param z: 2d elevation array
+    :param products: any of PRODUCTS
+    :param cache: (bool) memoize on the contents of <z> and the params.
+        cached arrays are read-only
+    :return: dict of product name: array
+    """
+    products = tuple(products)
+    unknown = set(products) - set(PRODUCTS)
+    if unknown:
+        raise ValueError(f'unknown terrain products {unknown}')
+
+    def compute():
+        dz_dx, dz_dy = gradients(z, dx, dy)
+        funcs = {
+            'slope': lambda: slope(dz_dx, dz_dy),
+            'aspect': lambda: aspect(dz_dx, dz_dy),
+            'hillshade': lambda: hillshade(dz_dx, dz_dy, azimuth, altitude),
+            'curvature': lambda: curvature(dz_dx, dz_dy, dx, dy),
+        }
+        return {name: funcs[name]() for name in products}
+
+    if not cache:
+        return compute()
+    key = ('derive', _fingerprint(z), dx, dy, products, azimuth, altitude)
+    return _cached(key, compute)
+
+
+def _fill_voids(z, nodata=None):
+    """
+    <z> as floats, w/ nodatas (np.nan or <nodata>) filled w/ the lowest
+    valid value. not a copy if there's nothing to fill
+    """
+    z = np.asarray(z, dtype=float)
+    void = np.isnan(z)
+    if nodata is not None and not np.isnan(nodata):
+        void |= z == nodata
+    if void.any() and not void.all():
+        z = np.where(void, z[~void].min(), z)
+    return z
+
+
+def shade(z, dx=1, dy=-1, cmap=None, azimuth=315, altitude=45, nodata=None):
+    """
+    rgba image of <z> colored by <cmap> and shaded by a light at
+    <azimuth>/<altitude>, blended like matplotlib's LightSource.shade.
+    nodatas (np.nan or <nodata>) are shaded as the lowest valid value.
+    cached on the contents of <z> and the params (the result is read-only)
+    """
+    if not callable(cmap):
+        cmap = mpl.colormaps[cmap or mpl.rcParams['image.cmap']]
+
+    def compute():
+        z_filled = _fill_voids(z, nodata)
+        dz_dx, dz_dy = gradients(z_filled, dx, dy)
+        intensity = illumination(dz_dx, dz_dy, azimuth, altitude)
+        i_min, i_max = intensity.min(), intensity.max()
+        if i_max - i_min > 1e-6:
+            intensity = (intensity - i_min) / (i_max - i_min)
+        intensity = np.clip(intensity, 0, 1)[..., np.newaxis]
+        norm = mpl.colors.Normalize(z_filled.min(), z_filled.max())
+        rgba = cmap(norm(z_filled))
+        ls = mpl.colors.LightSource(azdeg=azimuth, altdeg=altitude)
+        rgba[..., :3] = ls.blend_overlay(rgba[..., :3], intensity)
+        return rgba
+
+    key = ('shade', _fingerprint(z), dx, dy, cmap.name, azimuth, altitude,
+           nodata)
+    return _cached(key, compute)
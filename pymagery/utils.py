@@ -1,5 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
 import geopandas as gpd
 import folium
+import rasterio.features
+
+import pymagery
 
 
 def plot_geoms(geoms, ax,
@@ -67,3 +73,119 @@ def show_gdf(gdf, m=None, popup=None, tooltip=None, style_function=None):
                    tooltip=tooltip,
                    style_function=style_function).add_to(m)
     return m
+
+
+# default stats for zonal_stats
+dflt_stats = ('count', 'mean', 'min', 'max', 'std')
+
+# batches of polygons whose combined window has fewer pixels than this are
+# read from the raster in one go
+max_batch_pixels = 2 ** 22
+
+
+def _polygon_stats(band, inside, stats, percentiles):
+    """
+    stats of the valid pixels of <band> where <inside>
+    """
+    vals = np.asarray(band)[inside & ~band.mask]
+    out = {}
+    for stat in stats:
+        if stat == 'count':
+            out[stat] = vals.size
+        elif vals.size == 0:
+            out[stat] = np.nan
+        else:
+            out[stat] = getattr(np, stat)(vals)
+    if percentiles:
+        qs = (np.percentile(vals, percentiles) if vals.size
+              else [np.nan] * len(percentiles))
+        out.update({f'p{q:g}': val for q, val in zip(percentiles, qs)})
+    return out
+
+
+def _batch_stats(batch, raster, stats, percentiles, all_touched):
+    """
+    stats for a batch of (window, geom) pairs. if the batch is compact,
+    its combined window is read once and the polygons' windows are sliced
+    out of it
+    """
+    windows = [window for window, geom in batch if window is not None]
+    block, origin = raster, None
+    if windows:
+        row_min = min(window.row_off for window in windows)
+        col_min = min(window.col_off for window in windows)
+        row_max = max(window.row_off + window.n_rows for window in windows)
+        col_max = max(window.col_off + window.n_cols for window in windows)
+        if (row_max - row_min) * (col_max - col_min) <= max_batch_pixels:
+            origin = pymagery.Window(row_min, col_min, row_max - row_min,
+                                     col_max - col_min)
+            block = raster.read_window(origin).load()
+    rows = []
+    for window, geom in batch:
+        row = {}
+        if window is None:
+            sub = None
+        elif origin is None:
+            sub = raster.read_window(window).load()
+        else:
+            sub = block.read_window(window.relative_to(origin))
+        if sub is not None:
+            # rasterized once, for all the bands
+            inside = rasterio.features.geometry_mask(
+                [geom], out_shape=sub.shape, transform=sub.aff,
+                invert=True, all_touched=all_touched)
+        for key, band in raster.bands.items():
+            if sub is None:
+                band_stats = {stat: 0 if stat == 'count' else np.nan
+                              for stat in stats}
+                band_stats.update({f'p{q:g}': np.nan for q in percentiles})
+            else:
+                band_stats = _polygon_stats(sub[key], inside, stats,
+                                            percentiles)
+            row.update({f'{key}_{stat}': val
+                        for stat, val in band_stats.items()})
+        rows.append(row)
+    return rows
+
+
+def zonal_stats(gdf, raster, stats=dflt_stats, percentiles=(),
+                all_touched=False, batch_size=256, max_workers=None):
+    """
+    stats of each band of <raster> within each polygon of <gdf>. polygons
+    are rasterized only over their own bounding windows, and only those
+    windows are read from lazy rasters. batches of polygons are processed
+    in parallel threads
+    :param stats: any of 'count', 'mean', 'min', 'max', 'std', 'median',
+        'sum' (nodata pixels are ignored)
+    :param percentiles: e.g. (10, 90), reported as '<band>_p10' etc.
+    :param all_touched: (bool) count every pixel a polygon touches, not
+        just those whose centers are inside it
+    :return: DataFrame indexed like <gdf>, w/ columns '<band>_<stat>'
+    """
+    if gdf.crs is not None and raster.crs is not None:
+        gdf = gdf.to_crs(raster.crs)
+    items = []
+    for geom in gdf.geometry:
+        window = None
+        if geom is not None and not geom.is_empty:
+            window = raster.bounds_to_window(geom.bounds)
+            if window.n_rows == 0 or window.n_cols == 0:
+                window = None
+        items.append((window, geom))
+    # batch polygons that are near each other, so batches read compact
+    # windows
+    order = sorted(range(len(items)), key=lambda i: (
+        (-1, -1) if items[i][0] is None
+        else (items[i][0].row_off, items[i][0].col_off)))
+    batches = [[items[i] for i in order[start:start + batch_size]]
+               for start in range(0, len(order), batch_size)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(
+            lambda batch: _batch_stats(batch, raster, stats, percentiles,
+                                       all_touched), batches)
+        rows = [row for batch_rows in results for row in batch_rows]
+    # back to the original order
+    ordered = [None] * len(rows)
+    for i, row in zip(order, rows):
+        ordered[i] = row
+    return pd.DataFrame(ordered, index=gdf.index)
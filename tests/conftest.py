@@ -79,12 +79,12 @@ def sb(band, aff):
 
 
 @pytest.fixture
-def mb(mb_bands):
+def mb(mb_bands, aff):
     return pymagery.MultiBand(bands=mb_bands, aff=aff)
 
 
 @pytest.fixture
-def rgb(rgb_bands):
+def rgb(rgb_bands, aff):
     return pymagery.RGB(bands=rgb_bands, aff=aff)
 
 
@@ -1,8 +1,12 @@
+import os
+import time
+import pickle
+import asyncio
 import pymagery
 import numpy as np
 import pytest
 
-from pymagery import context
+from pymagery import context, instrument, utils
 
 
 def test_band_subsetting(arr, band):
@@ -184,6 +188,69 @@ def test_copies(raster, sb, rgb, mb):
     assert mb.copy() == mb
 
 
+def test_copy_on_write(sb, arr):
+    copied = sb.copy()
+    assert copied.band is sb.band
+    assert not copied.band.flags.writeable
+    with pytest.raises(ValueError):
+        copied.band[0, 0] = 99
+    # reading by key doesn't copy
+    assert copied[0] is sb.band
+    copied.bands.writable(0)[0, 0] = 99
+    assert copied.band[0, 0] == 99
+    assert sb.band[0, 0] == arr[0, 0]
+    # the last holder gets the band back writeable, w/o a copy
+    original = sb.band
+    sb.bands.writable(0)[0, 0] = -1
+    assert sb.band is original
+
+
+def test_copy_on_write_inplace(mb):
+    copied = mb.copy()
+    copied.fill_negs(5, inplace=True)
+    copied.bands[1] += 1
+    assert (mb.bands[1] <= 1).all()
+    assert (copied.iloc[0] >= 1).all()
+
+
+def test_copy_on_write_buffer():
+    mb = pymagery.MultiBand.from_array(np.zeros((2, 3, 4)))
+    copied = mb.copy()
+    assert np.shares_memory(copied.arr, mb.arr)
+    assert not copied.arr.flags.writeable
+    # the original's buffer isn't swapped for a read-only view
+    buffer = mb.bands.buffer
+    assert buffer.flags.writeable
+    # reads don't copy or drop the buffer
+    assert not mb['0'].flags.writeable
+    assert mb.bands.buffer is buffer
+    assert np.shares_memory(mb.arr, buffer)
+    # the writer gets its own buffer, the other copy keeps the old one
+    copied.bands['0'] = np.ones((3, 4))
+    assert copied.bands.buffer is not None
+    assert not np.shares_memory(copied.arr, buffer)
+    assert np.shares_memory(copied.arr, copied.bands.buffer)
+    assert mb.bands.buffer is buffer
+    assert (mb.bands['0'] == 0).all()
+    mb.bands['1'] = np.full((3, 4), 2)
+    assert (copied.bands['1'] == 0).all()
+
+
+def test_copy_on_write_released():
+    mb = pymagery.MultiBand.from_array(np.full((2, 3, 4), np.nan))
+    buffer = mb.bands.buffer
+    copied = mb.copy()
+    # reading bands by name doesn't copy them
+    copied.eval('b0 + b1')
+    assert copied.bands.buffer is buffer
+    assert not mb.bands.iloc[0].flags.writeable
+    del copied
+    assert mb.bands.iloc[0].flags.writeable
+    mb.fill_nans(1, inplace=True)
+    assert mb.bands.buffer is buffer
+    assert (buffer == 1).all()
+
+
 def test_sb_fill_nans(arr_wit_nans):
     sb = pymagery.SingleBand(band=arr_wit_nans)
     filled = sb.fill_nans(0)
@@ -209,6 +276,28 @@ def test_mb_fill_nans(mb, arr_wit_nans):
         assert (mb[band_name][nan_locs] == -99).all()
 
 
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+@pytest.mark.parametrize('inplace', [False, True])
+def test_mb_fill_nans_executor(arr_wit_nans, executor, inplace):
+    buffer = np.stack([arr_wit_nans, arr_wit_nans + 1])
+    mb = pymagery.MultiBand.from_array(buffer, names=['a', 'b'])
+    filled = mb.fill_nans(-99, inplace=inplace, executor=executor)
+    assert (filled is mb) == inplace
+    assert filled.bands.buffer is not None
+    assert (filled.bands['a'][0, :3] == -99).all()
+    np.testing.assert_equal(filled.bands['b'][1:], arr_wit_nans[1:] + 1)
+
+
+def test_process_executor_lazy():
+    dem_path = context.dem_paths[0]
+    lazy = pymagery.Raster.from_path(dem_path, lazy=True)
+    expected = pymagery.Raster.from_path(dem_path).fill_negs(0)
+    with pymagery.ProcessPoolExecutor(max_workers=2) as executor:
+        filled = lazy.fill_negs(0, executor=executor)
+    np.testing.assert_equal(filled.arr, expected.arr)
+    assert lazy.is_lazy
+
+
 def test_sb_from_path():
     dem_path = context.dem_paths[0]
     sb = pymagery.Raster.from_path(dem_path)
@@ -230,3 +319,940 @@ def test_rgb_from_path():
     rgb = pymagery.RGB.from_path(im_path)
     assert type(rgb) is pymagery.RGB
     assert list(rgb.bands.keys()) == ['r', 'g', 'b', 'a']
+
+
+def test_lazy_from_path():
+    dem_path = context.dem_paths[0]
+    lazy = pymagery.Raster.from_path(dem_path, lazy=True)
+    eager = pymagery.Raster.from_path(dem_path)
+    assert lazy.is_lazy
+    assert type(lazy.band) is pymagery.LazyBand
+    assert lazy.shape == eager.shape
+    assert lazy.bounds == eager.bounds
+    assert lazy.crs == eager.crs
+
+
+def test_lazy_band_slicing():
+    dem_path = context.dem_paths[0]
+    lazy = pymagery.Raster.from_path(dem_path, lazy=True)
+    eager = pymagery.Raster.from_path(dem_path)
+    for key in [(slice(2, 7), slice(1, 9)), (3, slice(None)),
+                (slice(None, None, 2), 4), (-1, -1)]:
+        sub = lazy.band[key]
+        np.testing.assert_equal(sub, eager.band[key])
+    loaded = lazy.load()
+    assert not loaded.is_lazy
+    np.testing.assert_equal(loaded.arr, eager.arr)
+
+
+def test_iter_blocks_covers_raster(sb):
+    seen = np.zeros(sb.shape, dtype=int)
+    for window, block in sb.iter_blocks(block_shape=(2, 3), halo=1):
+        assert block.shape == window.outer.shape
+        assert window.trim(block).shape == window.shape
+        seen[window.slices] += 1
+    assert (seen == 1).all()
+
+
+def test_map_blocks(sb, arr_wit_nans):
+    sb.band = arr_wit_nans
+    filled = sb.map_blocks(lambda block: block.fill_nans(-1),
+                           block_shape=(2, 2), halo=1)
+    np.testing.assert_equal(filled.arr, sb.fill_nans(-1).arr)
+    assert filled.aff == sb.aff
+
+
+def test_map_blocks_to_path(tmp_path):
+    dem = pymagery.Raster.from_path(context.dem_paths[0], lazy=True)
+    path = str(tmp_path / 'filled.tif')
+    filled = dem.map_blocks(lambda block: block.fill_nans(0),
+                            block_shape=(5, 7), halo=2, path=path)
+    assert filled.is_lazy
+    assert filled.bounds == dem.bounds
+    np.testing.assert_equal(filled.arr, dem.fill_nans(0).arr)
+
+
+def test_crop_bounds(sb, arr):
+    # aff puts pixel (0, 0) at x in [10, 11], y in [19, 20]
+    cropped = sb.crop((11, 17, 13, 19))
+    np.testing.assert_equal(cropped.arr, arr[1:3, 1:3])
+    assert cropped.bounds == (11, 17, 13, 19)
+    assert type(cropped) is pymagery.SingleBand
+
+
+def test_crop_lazy_geometry():
+    dem_path = context.dem_paths[0]
+    lazy = pymagery.Raster.from_path(dem_path, lazy=True)
+    eager = pymagery.Raster.from_path(dem_path)
+    aoi = lazy.bounding_box.buffer(-10 * abs(lazy.dx))
+    cropped = lazy.crop(aoi)
+    window = eager.bounds_to_window(aoi.bounds)
+    np.testing.assert_equal(cropped.arr, eager.arr[window.slices])
+    assert cropped.shape == window.shape
+    assert cropped.aff * (0, 0) == eager.aff * (window.col_off,
+                                                window.row_off)
+
+
+def test_crop_no_overlap(sb):
+    with pytest.raises(ValueError):
+        sb.crop((100, 100, 101, 101))
+
+
+def test_from_paths(tmp_path, arr, aff):
+    paths = []
+    for i in range(3):
+        path = str(tmp_path / f'b{i}.tif')
+        sb = pymagery.SingleBand(band=arr + i, aff=aff, crs='epsg:26911')
+        sb.to_path(path)
+        paths.append(path)
+    mb = pymagery.Raster.from_paths(paths, max_workers=3)
+    assert type(mb) is pymagery.MultiBand
+    assert mb.band_names == ['b0', 'b1', 'b2']
+    for i in range(3):
+        np.testing.assert_equal(mb.iloc[i], arr + i)
+    rgb = pymagery.RGB.from_paths(paths, lazy=True)
+    assert list(rgb.bands.keys()) == ['r', 'g', 'b']
+
+
+def test_from_paths_mismatched_grids(tmp_path, arr, aff):
+    paths = []
+    for i, a in enumerate([arr, arr[:2]]):
+        path = str(tmp_path / f'b{i}.tif')
+        pymagery.SingleBand(band=a, aff=aff).to_path(path)
+        paths.append(path)
+    with pytest.raises(ValueError, match='shape'):
+        pymagery.Raster.from_paths(paths)
+
+
+def test_band_keeps_dtype():
+    arr = np.arange(12, dtype=np.uint16).reshape(3, 4)
+    band = pymagery.Band(arr, dtype=None)
+    assert band.dtype == np.uint16
+    assert pymagery.Band(arr, dtype=np.float32).dtype == np.float32
+    assert pymagery.Band(arr).dtype == np.float64
+
+
+def test_band_no_copy(arr):
+    band = pymagery.Band(arr, copy=False)
+    assert np.shares_memory(band, arr)
+    band = pymagery.Band(arr)
+    assert not np.shares_memory(band, arr)
+
+
+def test_band_pickle_nodata():
+    band = pymagery.Band(np.arange(6).reshape(2, 3), dtype=None, nodata=-1)
+    loaded = pickle.loads(pickle.dumps(band))
+    assert type(loaded) is pymagery.Band
+    assert loaded.nodata == -1
+    np.testing.assert_equal(loaded, band)
+    mb = pymagery.MultiBand.from_array(np.zeros((2, 3, 4), dtype=np.uint16))
+    mb.bands['1'].nodata = 0
+    loaded = pickle.loads(pickle.dumps(mb))
+    assert [band.nodata for band in loaded.bands.values()] == [None, 0]
+
+
+def test_band_from_memmap(tmp_path):
+    path = str(tmp_path / 'band.raw')
+    arr = np.arange(12, dtype=np.int16).reshape(3, 4)
+    arr.tofile(path)
+    band = pymagery.Band.from_memmap(path, (3, 4), np.int16, nodata=-1)
+    assert type(band) is pymagery.Band
+    assert band.dtype == np.int16
+    assert band.nodata == -1
+    assert band[1:].nodata == -1
+    np.testing.assert_equal(band, arr)
+    raster = pymagery.SingleBand(band=band)
+    assert raster.band is band
+
+
+@pytest.fixture
+def int_band():
+    arr = np.array([[1, -9, 3, -1],
+                    [2, 5, -9, 4],
+                    [7, 1, 2, 6]], dtype=np.int16)
+    return pymagery.Band(arr, dtype=None, nodata=-9)
+
+
+def test_band_nodata_mask(int_band, arr_wit_nans):
+    assert int_band.mask.sum() == 2
+    assert (pymagery.Band(arr_wit_nans).mask == np.isnan(arr_wit_nans)).all()
+
+
+def test_int_band_fill_nans(int_band):
+    filled = int_band.fill_nans(0)
+    assert filled.dtype == np.int16
+    assert filled[0, 1] == 0 and filled[1, 2] == 0
+    assert not filled.mask.any()
+
+
+def test_int_band_fill_negs(int_band):
+    filled = int_band.fill_negs(0)
+    # nodata is left for fill_nans
+    assert filled[0, 3] == 0
+    assert filled[0, 1] == -9
+
+
+def test_int_band_interp(int_band):
+    interpd = int_band.interp()
+    assert not interpd.mask.any()
+    assert interpd[0, 0] == int_band[0, 0]
+
+
+def test_sb_minmax_nodata(int_band):
+    sb = pymagery.SingleBand(band=int_band)
+    assert sb.min() == -1
+    assert sb.max() == 7
+
+
+@pytest.mark.parametrize('interleave', ['band', 'pixel'])
+def test_mb_from_array(interleave):
+    shape = (3, 2, 4) if interleave == 'band' else (2, 4, 3)
+    buffer = np.arange(24, dtype=np.float32).reshape(shape)
+    mb = pymagery.MultiBand.from_array(buffer, names=['a', 'b', 'c'],
+                                       interleave=interleave)
+    assert mb.shape == (2, 4)
+    for band in mb.bands.values():
+        assert np.shares_memory(band, buffer)
+    assert np.shares_memory(mb.arr, buffer)
+    assert mb.arr.shape == (2, 4, 3)
+    assert np.shares_memory(mb.iloc[1:], buffer)
+    assert mb.iloc[1:].shape == (2, 2, 4)
+    # setting a band writes into the buffer
+    mb['b'] = np.ones((2, 4), dtype=np.float32)
+    assert (mb.arr[:, :, 1] == 1).all()
+    assert np.shares_memory(mb['b'], buffer)
+
+
+def test_buffer_no_lossy_cast():
+    buffer = np.arange(8, dtype=np.uint16).reshape(2, 2, 2)
+    mb = pymagery.MultiBand.from_array(buffer, names=['a', 'b'])
+    mb['a'] = mb['a'] / 2.0
+    assert mb['a'][0, 1] == 0.5
+    assert mb.bands.buffer is None
+    assert buffer[0, 0, 1] == 1
+    mb = pymagery.MultiBand.from_array(buffer, names=['a', 'b'])
+    mb['b'] = np.full((2, 2), -1)
+    assert mb['b'][0, 0] == -1
+    assert (buffer[1] >= 4).all()
+
+
+def test_rgb_keeps_buffer():
+    buffer = np.zeros((3, 2, 2))
+    rgb = pymagery.RGB(pymagery.MultiBand.from_array(buffer))
+    assert list(rgb.bands.keys()) == ['r', 'g', 'b']
+    assert np.shares_memory(rgb.arr, buffer)
+
+
+def test_iloc_slice(mb_bands):
+    sub = mb_bands.iloc[0:2]
+    assert sub.shape == (2, 2, 2)
+    assert (sub[1] == mb_bands[2]).all()
+
+
+def test_band_fill_nans_inplace(arr_wit_nans):
+    band = pymagery.Band(arr_wit_nans)
+    filled = band.fill_nans(9, inplace=True)
+    assert filled is band
+    assert (band[0, :3] == 9).all()
+
+
+def test_band_ops_out(arr_wit_nans):
+    band = pymagery.Band(arr_wit_nans)
+    out = np.empty_like(arr_wit_nans)
+    filled = band.fill_nans(9, out=out)
+    assert filled is out
+    assert (out[0, :3] == 9).all()
+    assert np.isnan(band[0, 0])
+    interpd = band.interp(out=out)
+    assert interpd is out
+    assert not np.isnan(out).any()
+
+
+def test_raster_fill_nans_inplace(mb, arr_wit_nans):
+    for band_name in mb.band_names:
+        mb[band_name] = arr_wit_nans[:2, :2]
+    filled = mb.fill_nans(-99, inplace=True)
+    assert filled is mb
+    for band_name in mb.band_names:
+        assert (mb[band_name][0, :2] == -99).all()
+
+
+def test_raster_fill_nans_preserves_original(mb, arr_wit_nans):
+    for band_name in mb.band_names:
+        mb[band_name] = arr_wit_nans[:2, :2]
+    filled = mb.fill_nans(-99)
+    for band_name in mb.band_names:
+        assert np.isnan(mb[band_name][0, 0])
+        assert filled[band_name][0, 0] == -99
+
+
+def test_raster_fill_negs_out(sb, arr_wit_negs):
+    sb.band = arr_wit_negs
+    out = pymagery.SingleBand(band=np.empty(sb.shape), aff=sb.aff)
+    filled = sb.fill_negs(0, out=out)
+    assert filled is out
+    assert (out.arr[0, :3] == 0).all()
+    assert (sb.arr[0, :3] < 0).all()
+
+
+def test_to_path_round_trip(tmp_path, sb, crs):
+    sb.crs = crs
+    path = str(tmp_path / 'sb.tif')
+    sb.to_path(path, compress='zstd')
+    read = pymagery.Raster.from_path(path)
+    np.testing.assert_equal(read.arr, sb.arr)
+    assert read.aff == sb.aff
+    assert pymagery._same_crs(read.crs, crs)
+
+
+def test_mb_to_path_dtype(tmp_path, aff):
+    buffer = np.arange(2 * 600 * 700, dtype=np.uint16).reshape(2, 600, 700)
+    mb = pymagery.MultiBand.from_array(buffer, aff=aff)
+    path = str(tmp_path / 'mb.tif')
+    mb.to_path(path, blocksize=256, overviews='auto')
+    read = pymagery.Raster.from_path(path, dtype=None)
+    assert read.iloc[0].dtype == np.uint16
+    np.testing.assert_equal(read.iloc[1], buffer[1])
+    ds = pymagery.gdal.Open(path)
+    assert ds.GetRasterBand(1).GetBlockSize() == [256, 256]
+    assert ds.GetRasterBand(1).GetOverviewCount() == 1
+
+
+def test_to_path_cog(tmp_path, aff):
+    sb = pymagery.SingleBand(band=np.random.rand(600, 600), aff=aff,
+                             crs='epsg:26911')
+    path = str(tmp_path / 'cog.tif')
+    sb.to_path(path, cog=True, blocksize=256)
+    ds = pymagery.gdal.Open(path)
+    assert ds.GetMetadataItem('LAYOUT', 'IMAGE_STRUCTURE') == 'COG'
+    np.testing.assert_equal(pymagery.Raster.from_path(path).arr, sb.arr)
+
+
+def test_to_path_cog_overviews(tmp_path, aff):
+    sb = pymagery.SingleBand(band=np.random.rand(600, 600), aff=aff)
+    path = str(tmp_path / 'cog.tif')
+    sb.to_path(path, cog=True, blocksize=256, overviews=[2, 4, 8])
+    gdal_band = pymagery.gdal.Open(path).GetRasterBand(1)
+    assert gdal_band.GetOverviewCount() == 3
+    assert gdal_band.GetOverview(2).XSize == 75
+
+
+def test_to_path_cog_uncompressed(tmp_path, sb):
+    path = str(tmp_path / 'cog.tif')
+    sb.to_path(path, cog=True, compress=None)
+    ds = pymagery.gdal.Open(path)
+    assert ds.GetMetadataItem('COMPRESSION', 'IMAGE_STRUCTURE') is None
+    np.testing.assert_equal(pymagery.Raster.from_path(path).arr, sb.arr)
+
+
+def test_pix_geo_conversion_arrays(sb):
+    i, j = np.array([0, 1, 2, 2]), np.array([0, 3, 1, 2])
+    x, y = sb.pix_to_geo(i, j)
+    i_out, j_out = sb.geo_to_pix(x + .5, y - .5)
+    assert (i_out == i).all()
+    assert (j_out == j).all()
+
+
+def test_geo_to_pix_shapely_points(sb):
+    points = [pymagery.shapely.geometry.Point(10.5, 19.5),
+              pymagery.shapely.geometry.Point(13.5, 17.5)]
+    i, j = sb.geo_to_pix(points)
+    assert list(i) == [0, 2]
+    assert list(j) == [0, 3]
+
+
+def test_sample(sb, arr):
+    x = np.array([10.5, 13.5, 50., 11.5])
+    y = np.array([19.5, 17.5, 50., 18.5])
+    sb.band[1, 1] = np.nan
+    values = sb.sample(x, y)
+    assert values.shape == (4,)
+    assert list(values.mask) == [False, False, True, True]
+    assert values[0] == arr[0, 0]
+    assert values[1] == arr[2, 3]
+
+
+def test_mb_sample(mb):
+    values = mb.sample([10.5], [19.5])
+    assert values.shape == (2, 1)
+    assert (values[:, 0] == [1, 0]).all()
+
+
+def test_decimate(aff):
+    sb = pymagery.SingleBand(band=np.random.rand(100, 60), aff=aff)
+    coarse = sb.decimate((20, 20))
+    assert coarse.shape == (34, 20)
+    assert coarse.aff.a == 3 * aff.a
+    np.testing.assert_allclose(coarse.bounds, sb.bounds)
+    np.testing.assert_equal(coarse.arr, sb.arr[::3, ::3])
+    window = pymagery.Window(10, 5, 50, 40)
+    coarse = sb.decimate((10, 10), window=window)
+    np.testing.assert_allclose(coarse.bounds,
+                               sb.read_window(window).bounds)
+    assert sb.decimate((200, 200)).shape == sb.shape
+
+
+def test_decimate_lazy(tmp_path, aff):
+    path = str(tmp_path / 'big.tif')
+    pymagery.SingleBand(band=np.random.rand(1200, 1100), aff=aff,
+                        crs='epsg:26911').to_path(path)
+    lazy = pymagery.Raster.from_path(path, lazy=True)
+    coarse = lazy.decimate((100, 100), build_overviews=True)
+    assert lazy.band.overview_count > 0
+    assert coarse.shape == (110, 100)
+    np.testing.assert_allclose(coarse.bounds, lazy.bounds)
+    # cached
+    assert lazy.decimate((100, 100)) is coarse
+
+
+def test_plot_decimates(aff):
+    sb = pymagery.SingleBand(band=np.random.rand(2000, 2000), aff=aff)
+    fig, ax = pymagery.plt.subplots(figsize=(2, 2), dpi=100)
+    sb.plot(ax=ax)
+    im = ax.get_images()[0]
+    assert max(im.get_array().shape) < 2000
+    pymagery.plt.close(fig)
+
+
+def test_resample(crs):
+    aff = pymagery.affine.Affine(1, 0, 10, 0, -1, 20)
+    sb = pymagery.SingleBand(band=np.ones((40, 60)), aff=aff, crs=crs)
+    coarse = sb.resample(factor=2, resampling='average')
+    assert coarse.shape == (20, 30)
+    assert coarse.dx == 2 and coarse.dy == -2
+    np.testing.assert_allclose(coarse.bounds, sb.bounds)
+    assert (coarse.arr == 1).all()
+
+
+def test_reproject_mb(crs):
+    aff = pymagery.affine.Affine(30, 0, 500000, 0, -30, 5300000)
+    buffer = np.random.rand(2, 50, 40)
+    mb = pymagery.MultiBand.from_array(buffer, names=['a', 'b'], aff=aff,
+                                       crs=crs)
+    warped = mb.reproject('epsg:4326')
+    assert type(warped) is pymagery.MultiBand
+    assert warped.band_names == ['a', 'b']
+    assert pymagery._same_crs(warped.crs, 'epsg:4326')
+    x_min, y_min, x_max, y_max = warped.bounds
+    assert -180 < x_min < x_max < 180
+
+
+def test_reproject_lazy_to_path(tmp_path):
+    dem = pymagery.Raster.from_path(context.dem_paths[0], lazy=True)
+    path = str(tmp_path / 'warped.tif')
+    warped = dem.reproject(resolution=abs(dem.dx) * 2, path=path)
+    assert warped.is_lazy
+    assert warped.dx == abs(dem.dx) * 2
+
+
+def test_reproject_lazy_dtype_and_nodata(tmp_path, crs):
+    aff = pymagery.affine.Affine(30, 0, 500000, 0, -30, 5300000)
+    mb = pymagery.MultiBand.from_array(
+        np.arange(2 * 20 * 10, dtype=np.uint16).reshape(2, 20, 10) + 1,
+        aff=aff, crs=crs)
+    path = str(tmp_path / 'uint16.tif')
+    mb.to_path(path, dtype=None)
+    ds = pymagery.gdal.Open(path, pymagery.gdal.GA_Update)
+    ds.GetRasterBand(1).SetNoDataValue(1)
+    ds.GetRasterBand(2).SetNoDataValue(2)
+    ds = None
+    lazy = pymagery.Raster.from_path(path, lazy=True)
+    eager = pymagery.Raster.from_path(path)
+    for raster in [lazy, eager]:
+        warped = raster.reproject(resolution=60)
+        assert [band.dtype for band in warped.bands.values()] == [
+            np.float64, np.float64]
+        assert [band.nodata for band in warped.bands.values()] == [1, 2]
+
+
+@pytest.fixture
+def tiles(crs):
+    # two 4x4 tiles overlapping by 2 cols, the second shifted right
+    left = pymagery.SingleBand(
+        band=np.ones((4, 4)), crs=crs,
+        aff=pymagery.affine.Affine(1, 0, 0, 0, -1, 4))
+    right = pymagery.SingleBand(
+        band=np.full((4, 4), 3.), crs=crs,
+        aff=pymagery.affine.Affine(1, 0, 2, 0, -1, 4))
+    right.band[0, 0] = np.nan
+    return left, right
+
+
+@pytest.mark.parametrize('method, expected', [
+    ('first', 1), ('last', 3), ('min', 1), ('max', 3), ('mean', 2)])
+def test_mosaic(tiles, method, expected):
+    merged = pymagery.mosaic(tiles, method=method)
+    assert type(merged) is pymagery.SingleBand
+    assert merged.shape == (4, 6)
+    assert merged.bounds == (0, 0, 6, 4)
+    assert (merged.arr[:, :2] == 1).all()
+    assert (merged.arr[:, 4:] == 3).all()
+    overlap = merged.arr[1:, 2:4]
+    assert (overlap == expected).all()
+    # nodata in the right tile doesn't count
+    assert merged.arr[0, 2] == 1
+
+
+def test_mosaic_bounds_and_paths(tmp_path, tiles):
+    paths = []
+    for i, tile in enumerate(tiles):
+        paths.append(str(tmp_path / f'tile{i}.tif'))
+        tile.to_path(paths[-1])
+    merged = pymagery.mosaic(paths, bounds=(1, 0, 5, 2), method='last')
+    assert merged.shape == (2, 4)
+    assert (merged.arr[:, 1:] == 3).all()
+    assert (merged.arr[:, 0] == 1).all()
+
+
+def test_mosaic_resampled(tiles):
+    merged = pymagery.mosaic(tiles, resolution=2, method='max')
+    assert merged.shape == (2, 3)
+    assert merged.arr[1, 2] == 3
+
+
+def test_mosaic_resampled_window(crs):
+    # the big input is off the output grid, only a window of it is warped
+    first = pymagery.SingleBand(
+        band=np.full((4, 4), np.nan), crs=crs,
+        aff=pymagery.affine.Affine(1, 0, 10.5, 0, -1, 60.5))
+    big = pymagery.SingleBand(
+        band=np.arange(10000.).reshape(100, 100), crs=crs,
+        aff=pymagery.affine.Affine(1, 0, 0, 0, -1, 100))
+    bounds = (10.5, 56.5, 14.5, 60.5)
+    merged = pymagery.mosaic([first, big], bounds=bounds)
+    expected = big.reproject(resolution=1, bounds=bounds)
+    assert merged.shape == (4, 4)
+    np.testing.assert_equal(merged.arr, expected.arr)
+
+
+def test_read_ahead_bounded():
+    lock = pymagery.threading.Lock()
+    state = {'pending': 0, 'max_pending': 0}
+
+    def func(i):
+        with lock:
+            state['pending'] += 1
+            state['max_pending'] = max(state['max_pending'], state['pending'])
+        return i
+
+    with pymagery.ThreadPoolExecutor(max_workers=2) as executor:
+        results = []
+        for i in pymagery._read_ahead(executor, func, range(10), 2):
+            results.append(i)
+            with lock:
+                state['pending'] -= 1
+    assert results == list(range(10))
+    assert state['max_pending'] <= 2
+
+
+@pytest.fixture
+def ramp(aff):
+    # rises 2 per pixel to the east
+    z = np.tile(np.arange(20, dtype=float) * 2, (15, 1))
+    return pymagery.SingleBand(band=z, aff=aff)
+
+
+def test_terrain_ramp(ramp):
+    derived = ramp.terrain()
+    assert set(derived) == set(pymagery.terrain.PRODUCTS)
+    np.testing.assert_allclose(derived['slope'].arr, np.degrees(np.arctan(2)))
+    np.testing.assert_allclose(derived['aspect'].arr, 270)
+    np.testing.assert_allclose(derived['curvature'].arr, 0, atol=1e-12)
+    assert derived['slope'].aff == ramp.aff
+
+
+def test_terrain_blocks_match(dem):
+    dem = dem.fill_nans(dem.min())
+    whole = dem.terrain()
+    tiled = dem.terrain(block_shape=(7, 9))
+    for name in whole:
+        np.testing.assert_allclose(tiled[name].arr, whole[name].arr)
+
+
+def test_terrain_to_path(tmp_path, dem):
+    dem = dem.fill_nans(dem.min())
+    whole = dem.terrain(products=['slope', 'curvature'])
+    path = str(tmp_path / 'terrain.tif')
+    streamed = dem.terrain(products=['slope', 'curvature'],
+                           block_shape=(7, 9), path=path)
+    assert streamed['slope'].is_lazy
+    for name in whole:
+        np.testing.assert_allclose(streamed[name].arr, whole[name].arr)
+
+
+def test_hill_shade_voids(ramp):
+    filled = ramp.mk_hill_shade()
+    ramp.band[0, 0] = np.nan
+    voided = ramp.mk_hill_shade()
+    assert voided is not filled
+    assert not np.isnan(voided).any()
+    # the void doesn't change the source
+    assert np.isnan(ramp.band[0, 0])
+
+
+def test_hill_shade_cached(ramp):
+    first = ramp.mk_hill_shade()
+    assert ramp.mk_hill_shade() is first
+    assert ramp.mk_hill_shade(azimuth=45) is not first
+    assert first.shape == (*ramp.shape, 4)
+
+
+@pytest.fixture
+def band_wit_void():
+    arr = np.tile(np.arange(10, dtype=float), (10, 1))
+    arr[3:6, 4:7] = np.nan
+    return pymagery.Band(arr)
+
+
+@pytest.mark.parametrize('method', ['nearest', 'idw', 'tiled'])
+def test_band_interp_methods(band_wit_void, method):
+    interpd = band_wit_void.interp(method=method, block_shape=(4, 4))
+    void = band_wit_void.mask
+    assert not interpd.mask.any()
+    np.testing.assert_equal(interpd[~void], band_wit_void[~void])
+    # values come from the void's neighborhood
+    assert (interpd[void] >= 3).all() and (interpd[void] <= 7).all()
+
+
+def test_band_interp_nearest(band_wit_void):
+    interpd = band_wit_void.interp(method='nearest')
+    assert interpd[4, 4] == 3
+    assert interpd[4, 6] == 7
+
+
+def test_band_interp_max_search_distance(band_wit_void):
+    interpd = band_wit_void.interp(method='idw', max_search_distance=1.5)
+    # the middle of the void is 2 pixels from valid data
+    assert np.isnan(interpd[4, 5])
+    assert not np.isnan(interpd[3, 4])
+
+
+def test_int_band_interp_idw(int_band):
+    interpd = int_band.interp(method='idw')
+    assert interpd.dtype == np.int16
+    assert not interpd.mask.any()
+
+
+def test_raster_interp_method(sb, arr_wit_nans):
+    sb.band = arr_wit_nans
+    interpd = sb.interp(method='nearest')
+    assert not np.isnan(interpd.arr).any()
+
+
+@pytest.fixture
+def parcels(crs):
+    box = pymagery.shapely.geometry.box
+    return utils.gpd.GeoDataFrame(
+        {'name': ['a', 'b', 'outside']},
+        geometry=[box(10, 17, 12, 20), box(12, 17, 14, 19),
+                  box(100, 100, 101, 101)],
+        crs=crs, index=[5, 6, 7])
+
+
+@pytest.mark.parametrize('batch_size', [1, 256])
+def test_zonal_stats(sb, arr, crs, parcels, batch_size):
+    sb.crs = crs
+    stats = utils.zonal_stats(parcels, sb, percentiles=(50,),
+                              batch_size=batch_size)
+    assert list(stats.index) == [5, 6, 7]
+    assert stats.loc[5, '0_count'] == 6
+    assert stats.loc[5, '0_mean'] == arr[:, :2].mean()
+    assert stats.loc[6, '0_max'] == arr[1:, 2:].max()
+    assert stats.loc[6, '0_p50'] == np.median(arr[1:, 2:])
+    assert stats.loc[7, '0_count'] == 0
+    assert np.isnan(stats.loc[7, '0_mean'])
+
+
+def test_zonal_stats_nodata(sb, arr_wit_nans, crs, parcels):
+    sb.crs = crs
+    sb.band = arr_wit_nans
+    stats = utils.zonal_stats(parcels, sb)
+    assert stats.loc[5, '0_count'] == 4
+
+
+def test_mb_eval(mb, aff):
+    evald = mb.eval('(b1 - b2) / (b1 + b2)', engine='numpy',
+                    block_shape=(1, 1))
+    assert isinstance(evald, pymagery.SingleBand)
+    assert evald.aff == aff
+    assert np.array_equal(evald.arr, [[1, -1], [-1, 1]])
+
+
+def test_mb_eval_funcs(mb):
+    evald = mb.eval('-sqrt(maximum(b1, b2) * 4) + 2 ** b1', engine='numpy')
+    assert np.array_equal(evald.arr, [[0, -1], [-1, 0]])
+
+
+def test_mb_eval_numexpr(mb):
+    pytest.importorskip('numexpr')
+    evald = mb.eval('(b1 - b2) / (b1 + b2)', engine='numexpr')
+    assert np.array_equal(evald.arr, [[1, -1], [-1, 1]])
+
+
+def test_mb_eval_int_nodata(aff):
+    buffer = np.array([[[1, 2], [3, 4]], [[1, 0], [0, 1]]], dtype=np.uint16)
+    mb = pymagery.MultiBand.from_array(buffer, names=['nir', 'red'], aff=aff)
+    mb.bands['red'].nodata = 0
+    evald = mb.eval('nir - 2 * red', engine='numpy')
+    assert evald.arr[0, 0] == -1
+    assert np.isnan(evald.arr[0, 1])
+
+
+def test_mb_eval_bad_expr(mb):
+    with pytest.raises(KeyError):
+        mb.eval('b3 + 1')
+    with pytest.raises(ValueError):
+        mb.eval('b1.real')
+    with pytest.raises(ValueError, match='no bands'):
+        mb.eval('3')
+    with pytest.raises(ValueError, match='float dtype'):
+        mb.eval('b1 / b2', dtype=int)
+
+
+def test_mb_eval_int(mb):
+    evald = mb.eval('b1 * 2 - b2', dtype=np.int64, engine='numpy')
+    assert evald.band.dtype == np.int64
+    np.testing.assert_equal(
+        evald.arr, (mb.bands.data[1] * 2 - mb.bands.data[2]).astype(int))
+
+
+@pytest.fixture
+def pixel_cache(monkeypatch):
+    monkeypatch.setattr(pymagery.cache, 'MAX_BYTES', 2 ** 20)
+    pymagery.cache.clear()
+    yield pymagery.cache
+    pymagery.cache.clear()
+
+
+def test_cache_hits(tmp_path, sb, pixel_cache):
+    path = str(tmp_path / 'sb.tif')
+    sb.to_path(path)
+    first = pymagery.Raster.from_path(path)
+    second = pymagery.Raster.from_path(path)
+    stats = pixel_cache.stats()
+    assert (stats['hits'], stats['misses']) == (1, 1)
+    assert stats['dataset_hits'] >= 1
+    np.testing.assert_equal(first.arr, second.arr)
+    # callers get their own copy
+    second.band[0, 0] = 99
+    np.testing.assert_equal(pymagery.Raster.from_path(path).arr, sb.arr)
+
+
+def test_cache_invalidation(tmp_path, sb, pixel_cache):
+    path = str(tmp_path / 'sb.tif')
+    sb.to_path(path)
+    pymagery.Raster.from_path(path)
+    mtime = os.stat(path).st_mtime_ns
+    sb.band = sb.band + 1
+    sb.to_path(path)
+    # in case both writes land in the same mtime tick
+    os.utime(path, ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+    np.testing.assert_equal(pymagery.Raster.from_path(path).arr, sb.arr)
+    assert pixel_cache.stats()['misses'] == 2
+
+
+def test_cache_eviction(tmp_path, sb, pixel_cache, monkeypatch):
+    monkeypatch.setattr(pixel_cache, 'MAX_BYTES', sb.band.nbytes)
+    paths = [str(tmp_path / f'{i}.tif') for i in range(2)]
+    for path in paths:
+        sb.to_path(path)
+        pymagery.Raster.from_path(path)
+    stats = pixel_cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['nbytes'] <= sb.band.nbytes
+
+
+def test_afrom_path(tmp_path, sb, crs):
+    sb.crs = crs
+    path = str(tmp_path / 'sb.tif')
+    sb.to_path(path)
+    read = asyncio.run(pymagery.Raster.afrom_path(path))
+    assert type(read) is pymagery.SingleBand
+    assert not read.is_lazy
+    np.testing.assert_equal(read.arr, sb.arr)
+    assert read.aff == sb.aff
+
+
+def test_aread_window(tmp_path, sb, arr):
+    path = str(tmp_path / 'sb.tif')
+    sb.to_path(path)
+    lazy = pymagery.Raster.from_path(path, lazy=True)
+    block = asyncio.run(lazy.aread_window((1, 1, 5, 2), strip_rows=1))
+    np.testing.assert_equal(block.arr, arr[1:, 1:3])
+    assert block.aff * (0, 0) == sb.aff * (1, 1)
+    cropped = asyncio.run(lazy.acrop((11, 17, 13, 19)))
+    np.testing.assert_equal(cropped.arr, arr[1:3, 1:3])
+
+
+def test_aread_window_cancel(tmp_path, sb):
+    path = str(tmp_path / 'sb.tif')
+    sb.to_path(path)
+    lazy = pymagery.Raster.from_path(path, lazy=True)
+    read_window, calls = lazy.read_window, []
+
+    def slow_read_window(window):
+        calls.append(window)
+        time.sleep(0.05)
+        return read_window(window)
+
+    lazy.read_window = slow_read_window
+
+    async def read_then_cancel():
+        task = asyncio.ensure_future(
+            lazy.aread_window((0, 0, *lazy.shape), strip_rows=1))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(read_then_cancel())
+    assert len(calls) == 1
+
+
+def test_afrom_paths(tmp_path, arr, aff):
+    paths = []
+    for i in range(3):
+        path = str(tmp_path / f'b{i}.tif')
+        pymagery.SingleBand(band=arr + i, aff=aff).to_path(path)
+        paths.append(path)
+    max_concurrency = pymagery._io_limits['max_concurrency']
+    pymagery.set_io_limits(max_concurrency=2)
+    try:
+        mb = asyncio.run(pymagery.Raster.afrom_paths(paths))
+    finally:
+        pymagery.set_io_limits(max_concurrency=max_concurrency)
+    assert mb.band_names == ['b0', 'b1', 'b2']
+    for i in range(3):
+        np.testing.assert_equal(mb.iloc[i], arr + i)
+
+
+def test_parse_date():
+    date = pymagery.parse_date('a/T10TFT_20201002T191229_B08_10m.jp2')
+    assert date == np.datetime64('2020-10-02T19:12:29')
+    assert pymagery.parse_date('dem_20200101.tif') == np.datetime64(
+        '2020-01-01')
+    with pytest.raises(ValueError):
+        pymagery.parse_date('dem.tif')
+
+
+@pytest.fixture
+def scenes(tmp_path, arr, aff):
+    paths = []
+    for day, offset in [(3, 2), (1, 0), (2, 1)]:
+        path = str(tmp_path / f'T10TFT_2020100{day}T191229_B08.tif')
+        band = arr + offset
+        band[0, 0] = np.nan if day == 1 else band[0, 0]
+        pymagery.SingleBand(band=band, aff=aff).to_path(path)
+        paths.append(path)
+    return paths
+
+
+def test_raster_stack(scenes, arr):
+    stack = pymagery.RasterStack.from_paths(scenes)
+    assert stack.shape == (3, 1, *arr.shape)
+    assert list(stack.dates.astype(str)) == [
+        f'2020-10-0{day}T19:12:29' for day in (1, 2, 3)]
+    assert stack[0].is_lazy
+    cube = np.asarray(stack)
+    np.testing.assert_equal(cube[:, 0, 1], [arr[1], arr[1] + 1, arr[1] + 2])
+
+
+def test_raster_stack_reductions(scenes, arr):
+    stack = pymagery.RasterStack.from_paths(scenes)
+    median = stack.median(block_shape=(2, 3))
+    assert type(median) is pymagery.SingleBand
+    expected = arr + 1
+    expected[0, 0] = arr[0, 0] + 1.5
+    np.testing.assert_equal(median.arr, expected)
+    count = stack.count_valid(block_shape=(1, 1))
+    assert count.arr[0, 0] == 2
+    assert (count.arr.ravel()[1:] == 3).all()
+
+
+def test_raster_stack_max_ndvi(aff):
+    nir = np.array([[[5., 5.], [5., np.nan]]])
+    red = np.array([[[1., 4.], [4., np.nan]]])
+    rasters = [pymagery.MultiBand.from_array(np.concatenate([nir, red]),
+                                             names=['nir', 'red'], aff=aff)
+               for _ in range(2)]
+    rasters[1].bands['red'][0] = [4, 1]
+    stack = pymagery.RasterStack(rasters, ['2020-01-01', '2020-01-02'])
+    composite = stack.max_ndvi('nir', 'red')
+    assert type(composite) is pymagery.MultiBand
+    np.testing.assert_equal(composite.bands['red'], [[1, 1], [4, np.nan]])
+
+
+def test_instrument_record(tmp_path, sb):
+    path = str(tmp_path / 'sb.tif')
+    sb.to_path(path)
+    original = pymagery.Band.__dict__['__new__']
+    with instrument.record() as events:
+        read = pymagery.Raster.from_path(path)
+        read.fill_nans(0)
+        read.copy()
+    assert pymagery.Band.__dict__['__new__'] is original
+    assert not instrument.is_enabled()
+    totals = instrument.summary(events, depth=0)
+    assert list(totals) == ['Raster.from_path', 'Raster._map_bands',
+                            'SingleBand.copy']
+    assert totals['Raster.from_path']['bytes_read'] == sb.band.nbytes
+    assert totals['SingleBand.copy']['copies'] == 0
+    assert instrument.summary(events)['LazyBand.read']['count'] == 1
+
+
+def test_instrument_hook(sb):
+    seen = []
+    instrument.add_hook(seen.append)
+    try:
+        sb.arr
+        assert seen == []
+        instrument.enable()
+        try:
+            sb.arr
+        finally:
+            instrument.disable()
+        sb.arr
+    finally:
+        instrument.remove_hook(seen.append)
+    assert [event['name'] for event in seen] == ['Bands.stack', 'Raster.arr',
+                                                 'SingleBand.arr']
+    assert seen[0]['copies'] == 1
+    assert seen[0]['bytes_allocated'] == sb.band.nbytes
+
+
+@pytest.mark.parametrize('in_file', [False, True])
+def test_share(tmp_path, rgb, crs, in_file):
+    rgb.crs = crs
+    rgb.bands['g'].nodata = -1
+    shared = rgb.share(path=str(tmp_path / 'rgb.dat') if in_file else None)
+    try:
+        opened = pymagery.Raster.from_shared(shared)
+        assert type(opened) is pymagery.RGB
+        np.testing.assert_equal(opened.arr, rgb.arr)
+        assert (opened.crs, opened.aff) == (rgb.crs, rgb.aff)
+        assert opened.bands['g'].nodata == -1
+        assert not opened.arr.flags.writeable
+        writeable = pymagery.Raster.from_shared(shared, writeable=True)
+        writeable.bands['r'][0, 0] = 7
+        assert opened.bands['r'][0, 0] == 7
+        # the band, not the raster, keeps the memory mapped
+        band = pymagery.Raster.from_shared(shared).bands['b']
+        assert band.sum() == rgb.bands['b'].sum()
+        del opened, writeable, band
+    finally:
+        shared.close()
+        shared.unlink()
+
+
+def _shared_sum(shared):
+    return float(pymagery.Raster.from_shared(shared).band.sum())
+
+
+def test_share_across_processes(sb):
+    shared = sb.share()
+    try:
+        with pymagery.ProcessPoolExecutor(max_workers=1) as executor:
+            total = executor.submit(_shared_sum, shared).result()
+    finally:
+        shared.unlink()
+    assert total == sb.band.sum()